@@ -1,6 +1,13 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file, abort, Response
+from flask import Flask, Request, render_template, request, redirect, url_for, session, jsonify, send_file, abort, Response
 import os
 import uuid
+import base64
+import calendar
+import hmac
+import io
+import re
+import threading
+import time
 from werkzeug.utils import secure_filename
 import mimetypes
 from typing import Union
@@ -8,22 +15,135 @@ from typing import Union
 from config import *
 from database import *
 from utils import allowed_file, get_file_icon, format_file_size, is_image_file
+import archive
+import blobstore
+import delta
+import metrics
+import reaper
+import thumbnails
+from logs import configure_logging, get_logger
+from serving import send_stored_file
+
+logger = get_logger('app')
+
+
+class UploadRequest(Request):
+    """Request that streams uploaded files into hashed temporary files"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = blobstore.HashingTempFile()
+        self.upload_temp_files.append(stream)
+        return stream
+
+    @property
+    def upload_temp_files(self):
+        """Temporary files created while parsing this request"""
+        if '_upload_temp_files' not in self.__dict__:
+            self._upload_temp_files = []
+        return self._upload_temp_files
 
-from PIL import Image
-import io
 
 app = Flask(__name__)
 app.config.from_object('config')
+app.request_class = UploadRequest
+
+_started = False
+_start_lock = threading.Lock()
+
 
-# Initialize database
-with app.app_context():
-    init_db()
+def start():
+    """Set up logging and the database and start background work, once per process
+
+    Runs before the first request rather than at import: thumbnail workers
+    import the server's main module again, and must not migrate the
+    database or run a reaper of their own.
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        configure_logging()
+        with app.app_context():
+            init_db()
+        # Deleted files are removed from disk in the background
+        reaper.storage_reaper.start()
+        _started = True
+
+
+@app.before_request
+def start_once():
+    if not _started:
+        start()
+
+
+# Hand each request's pooled connection back when the request ends
+app.teardown_appcontext(release_db)
+
+
+@app.before_request
+def start_request_metrics():
+    """Start timing the request and counting its queries"""
+    if METRICS_ENABLED:
+        metrics.start_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    """Record latency, queries and body sizes of the request"""
+    if not METRICS_ENABLED:
+        return response
+
+    endpoint = request.endpoint or 'unmatched'
+    bytes_out = 0
+    if response.status_code not in (204, 304):
+        if response.content_length is not None:
+            bytes_out = response.content_length
+        elif response.is_streamed:
+            # Archives are built while they're sent, count them on the way
+            response.response = metrics.count_streamed(response.response, endpoint)
+
+    elapsed = metrics.finish_request(endpoint, request.method, response.status_code,
+                                     request.content_length or 0, bytes_out)
+    if elapsed is not None:
+        logger.debug('Request handled', extra={
+            'endpoint': endpoint, 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 2)
+        })
+    return response
+
+
+# Row cache counters are read straight from the caches on each scrape
+metrics.registry.register(metrics.CallbackMetric(
+    'row_cache_hits_total', 'Row cache lookups answered from memory',
+    lambda: {name: stats['hits'] for name, stats in cache_stats().items()}, ('cache',), kind='counter'
+))
+metrics.registry.register(metrics.CallbackMetric(
+    'row_cache_misses_total', 'Row cache lookups that went to the database',
+    lambda: {name: stats['misses'] for name, stats in cache_stats().items()}, ('cache',), kind='counter'
+))
+metrics.registry.register(metrics.CallbackMetric(
+    'row_cache_hit_ratio', 'Share of row cache lookups answered from memory',
+    lambda: {name: stats['hit_ratio'] for name, stats in cache_stats().items()}, ('cache',)
+))
+metrics.registry.register(metrics.CallbackMetric(
+    'row_cache_rows', 'Rows held by each row cache',
+    lambda: {name: stats['size'] for name, stats in cache_stats().items()}, ('cache',)
+))
+
+
+@app.teardown_request
+def discard_upload_temp_files(exception=None):
+    """Remove uploaded files that didn't make it into the blob store"""
+    for stream in request.upload_temp_files:
+        stream.discard()
 
 
 @app.before_request
 def before_request():
     """Check if user is logged in for protected routes"""
     protected_routes = ['dashboard', 'upload', 'download', 'delete', 'share']
+    # Visitors with a share link download without an account
+    if request.endpoint == 'download' and request.args.get('token'):
+        return None
     if request.endpoint in protected_routes and 'user_id' not in session:
         return redirect(url_for('auth_page'))
 
@@ -76,78 +196,82 @@ def auth_page():
 
 @app.route('/create-folder', methods=['POST'])
 def create_folder():
-    """Create a new folder"""
+    """Create a new folder, optionally inside another one"""
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
     user_id = session['user_id']
     folder_name = request.form.get('folder_name', '').strip()
+    parent = normalize_folder_path(request.form.get('parent', ''))
 
-    print(f"DEBUG: Creating folder. User ID: {user_id}, Folder name: '{folder_name}'")
-
-    if not folder_name:
-        return jsonify({'error': 'Folder name is required'}), 400
+    logger.debug('Creating folder', extra={'user_id': user_id, 'folder_name': folder_name, 'parent': parent})
 
     # Sanitize folder name
     folder_name = secure_filename(folder_name)
 
-    # Create folder path
-    folder_path = os.path.join(UPLOAD_FOLDER, str(user_id), folder_name)
-
-    print(f"DEBUG: Folder path: {folder_path}")
-    print(f"DEBUG: Upload folder base: {UPLOAD_FOLDER}")
+    if not folder_name:
+        return jsonify({'error': 'Folder name is required'}), 400
 
-    try:
-        # Check if folder already exists
-        if os.path.exists(folder_path):
-            return jsonify({'error': 'Folder already exists'}), 400
+    if parent and not get_folder(user_id, parent):
+        return jsonify({'error': 'Parent folder not found'}), 404
 
-        # Create folder
-        os.makedirs(folder_path, exist_ok=True)
+    folder_path = add_folder(user_id, folder_name, parent)
+    if folder_path is None:
+        return jsonify({'error': 'Folder already exists'}), 400
 
-        print(f"DEBUG: Folder created successfully")
+    logger.info('Folder created', extra={'user_id': user_id, 'folder': folder_path})
 
-        return jsonify({'success': True, 'folder_name': folder_name})
-    except Exception as e:
-        print(f"DEBUG: Error creating folder: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'Failed to create folder: {str(e)}'}), 500
+    return jsonify({'success': True, 'folder_name': folder_name, 'path': folder_path})
 
 
 @app.route('/get-folders')
 def get_folders():
-    """Get list of folders for current user"""
+    """Get the user's folders with their sizes
+
+    Without a parent the whole tree is returned, ordered by path.
+    """
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
     user_id = session['user_id']
-    user_dir = os.path.join(UPLOAD_FOLDER, str(user_id))
+    parent = request.args.get('parent')
+    if parent is not None:
+        parent = normalize_folder_path(parent)
 
-    print(f"DEBUG: Getting folders for user {user_id}")
-    print(f"DEBUG: User directory: {user_dir}")
-    print(f"DEBUG: Directory exists: {os.path.exists(user_dir)}")
+    folders = get_user_folders(user_id, parent)
+    for folder in folders:
+        folder['size_formatted'] = format_file_size(folder['size'])
 
-    folders = []
-    if os.path.exists(user_dir):
-        try:
-            # Get all directories
-            for item in os.listdir(user_dir):
-                item_path = os.path.join(user_dir, item)
-                if os.path.isdir(item_path):
-                    folders.append(item)
+    return jsonify({'folders': folders})
 
-            print(f"DEBUG: Found folders: {folders}")
-        except Exception as e:
-            print(f"DEBUG: Error listing folders: {str(e)}")
-    else:
-        print(f"DEBUG: User directory does not exist, creating it")
-        try:
-            os.makedirs(user_dir, exist_ok=True)
-        except Exception as e:
-            print(f"DEBUG: Error creating user directory: {str(e)}")
 
-    return jsonify({'folders': folders})
+@app.route('/move-folder', methods=['POST'])
+def move_folder():
+    """Rename a folder or move it under another one, with its subfolders"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    path = normalize_folder_path(request.form.get('folder', ''))
+    folder = get_folder(user_id, path) if path else None
+    if not folder:
+        return jsonify({'error': 'Folder not found'}), 404
+
+    # Missing fields keep the current parent and name
+    parent = path.rpartition('/')[0]
+    if 'parent' in request.form:
+        parent = normalize_folder_path(request.form['parent'])
+    new_name = secure_filename(request.form.get('name', folder['name']).strip())
+    if not new_name:
+        return jsonify({'error': 'Folder name is required'}), 400
+
+    logger.info('Moving folder', extra={'user_id': user_id, 'folder': path, 'parent': parent, 'new_name': new_name})
+
+    new_path = move_user_folder(user_id, path, parent, new_name)
+    if new_path is None:
+        return jsonify({'error': 'Target folder exists or is inside the folder'}), 400
+
+    return jsonify({'success': True, 'path': new_path})
 
 
 @app.route('/dashboard')
@@ -159,12 +283,7 @@ def dashboard():
     # Get current folder from query parameter
     current_folder = request.args.get('folder', '')
 
-    print(f"DEBUG: Loading dashboard. User: {user_id}, Folder: '{current_folder}'")
-
-    # Get user files for current folder
-    files = get_user_files(user_id, current_folder)
-
-    print(f"DEBUG: Found {len(files)} files for folder '{current_folder}'")
+    logger.debug('Loading dashboard', extra={'user_id': user_id, 'folder': current_folder})
 
     # Calculate storage usage
     user = get_user_by_id(user_id)
@@ -172,83 +291,217 @@ def dashboard():
     total_storage = user['storage_limit']
     storage_percentage = (used_storage / total_storage * 100) if total_storage > 0 else 0
 
-    # Format file data for template
-    formatted_files = []
-    for file in files:
-        # Check if file is an image
-        is_image = is_image_file(file['file_type'], file['mime_type'])
-
-        # Generate image URL with cache busting
-        image_url = None
-        if is_image:
-            image_url = url_for('image_preview', file_id=file['id'])
-
-        formatted_files.append({
-            'id': file['id'],
-            'name': file['original_filename'],
-            'size': format_file_size(file['file_size']),
-            'type': file['file_type'],
-            'icon': get_file_icon(file['file_type']),
-            'uploaded_at': file['uploaded_at'],
-            'is_public': bool(file['is_public']),
-            'public_token': file['public_token'],
-            'is_image': is_image,
-            'image_url': image_url,
-            'folder': file['folder'] if 'folder' in file else ''
-        })
-
+    # Files are loaded page by page from /api/files
     return render_template('dashboard.html',
                            username=username,
-                           files=formatted_files,
                            used_storage=format_file_size(used_storage),
                            total_storage=format_file_size(total_storage),
                            storage_percentage=min(storage_percentage, 100),
                            current_folder=current_folder)
 
 
+def encode_files_cursor(file):
+    """Build an opaque pagination cursor from a file's sort key"""
+    key = f"{file['uploaded_at']}|{file['id']}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_files_cursor(cursor):
+    """Parse a pagination cursor back into an (uploaded_at, id) key"""
+    try:
+        uploaded_at, file_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return uploaded_at, int(file_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+@app.route('/api/files')
+def api_files():
+    """API endpoint for one page of the file list"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    folder = request.args.get('folder', '')
+    limit = min(max(request.args.get('limit', FILES_PAGE_SIZE, type=int), 1), FILES_PAGE_SIZE_MAX)
+
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_files_cursor(cursor)
+        if after is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    # Fetch one extra row to learn whether another page exists
+    files = get_user_files_page(user_id, folder, after, limit + 1)
+    has_more = len(files) > limit
+    files = files[:limit]
+
+    return jsonify({
+        'files': [file_list_item(file) for file in files],
+        'next_cursor': encode_files_cursor(files[-1]) if has_more else None
+    })
+
+
+@app.route('/api/search')
+def api_search():
+    """API endpoint for searching the user's files by name and type"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    query = request.args.get('q', '').strip()
+    file_types = [t for value in request.args.getlist('type') for t in value.split(',') if t]
+    folder = request.args.get('folder', '')
+    limit = min(max(request.args.get('limit', FILES_PAGE_SIZE, type=int), 1), FILES_PAGE_SIZE_MAX)
+    before = request.args.get('cursor', type=int)
+
+    if not query and not file_types:
+        return jsonify({'error': 'Search query or type is required'}), 400
+
+    # Fetch one extra row to learn whether another page exists
+    files = search_user_files(user_id, query, file_types, folder, before, limit + 1)
+    has_more = len(files) > limit
+    files = files[:limit]
+
+    return jsonify({
+        'files': [file_list_item(file) for file in files],
+        'next_cursor': str(files[-1]['id']) if has_more else None
+    })
+
+
+def file_list_item(file):
+    """Compact JSON for one file in a list"""
+    is_image = is_image_file(file['file_type'], file['mime_type'])
+    return {
+        'id': file['id'],
+        'name': file['original_filename'],
+        'size': format_file_size(file['file_size']),
+        'icon': get_file_icon(file['file_type']),
+        'uploaded_at': file['uploaded_at'],
+        'public_token': file['public_token'],
+        'image_url': url_for('thumbnail', file_id=file['id'], size=THUMBNAIL_SIZES[0]) if is_image else None
+    }
+
+
+@app.route('/api/changes')
+def api_changes():
+    """API endpoint for what changed in the user's files and folders since a cursor
+
+    Without `since` only the current cursor is returned: take it, list
+    everything once, then poll with it. Entries other than 'deleted' carry
+    the item's current state, so only the last one per item is sent.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    pruned_through = int(get_gc_state('changes_pruned_through', '0'))
+    since = request.args.get('since')
+    if since is None:
+        # Never below the pruned part, or a quiet user's cursor would expire at once
+        cursor = max(get_latest_change_id(user_id), pruned_through)
+        return jsonify({'changes': [], 'cursor': str(cursor), 'has_more': False})
+    if not since.isdigit():
+        return jsonify({'error': 'Invalid cursor'}), 400
+    since = int(since)
+
+    # Entries after the cursor may have been pruned
+    if since < pruned_through:
+        return jsonify({'error': 'Cursor expired, list all files again', 'reset': True}), 410
+
+    limit = min(max(request.args.get('limit', CHANGES_PAGE_SIZE, type=int), 1), CHANGES_PAGE_SIZE_MAX)
+    # Fetch one extra row to learn whether another page exists
+    rows = get_changes(user_id, since, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    latest = {}
+    for row in rows:
+        latest.pop((row['item_type'], row['item_id']), None)
+        latest[(row['item_type'], row['item_id'])] = change_item(row)
+
+    return jsonify({
+        'changes': list(latest.values()),
+        'cursor': str(rows[-1]['id'] if rows else since),
+        'has_more': has_more
+    })
+
+
+def change_item(row):
+    """JSON for one change journal entry"""
+    item = {
+        'type': row['item_type'],
+        'id': row['item_id'],
+        'action': row['action'],
+        'path': row['path'],
+        'changed_at': row['changed_at']
+    }
+    if row['item_type'] == 'file' and row['file_id'] is not None:
+        item['file'] = {
+            'name': row['original_filename'],
+            'folder': row['folder'],
+            'size': row['file_size'],
+            'mime_type': row['mime_type'],
+            'sha256': row['content_hash'],
+            'uploaded_at': row['uploaded_at'],
+            'public_token': row['public_token']
+        }
+    return item
+
+
 @app.route('/thumbnail/<int:file_id>')
 def thumbnail(file_id):
-    """Generate thumbnail for image files"""
+    """Serve a thumbnail of an image file, rendered in the background"""
     user_id = session.get('user_id')
 
-    # Check if user owns the file or file is public
+    # Check if user owns the file or came with a share link to it
     file = get_file_by_id(file_id)
     if not file:
         abort(404)
 
-    if file['user_id'] != user_id and not file['is_public']:
+    if file['user_id'] != user_id and not shared_link_for(file):
         abort(403)
 
     # Check if file is an image
     if not is_image_file(file['file_type'], file['mime_type']):
         abort(404)
 
-    # Check if thumbnail already exists
-    thumb_path = file['filepath'] + '.thumb'
-    if os.path.exists(thumb_path):
-        return send_file(thumb_path)
+    return send_thumbnail(file)
 
-    try:
-        # Create thumbnail
-        with Image.open(file['filepath']) as img:
-            # Calculate thumbnail size
-            img.thumbnail((300, 300))
-
-            # Save thumbnail to bytes
-            thumb_bytes = io.BytesIO()
-            img_format = img.format if img.format else 'JPEG'
-            img.save(thumb_bytes, format=img_format)
-            thumb_bytes.seek(0)
-
-            # Save thumbnail to disk for caching
-            with open(thumb_path, 'wb') as f:
-                f.write(thumb_bytes.getbuffer())
-
-            return send_file(thumb_path, mimetype='image/jpeg')
-    except Exception as e:
-        print(f"Error creating thumbnail: {e}")
-        # Fallback to original image
-        return send_file(file['filepath'])
+
+def send_thumbnail(file):
+    """Send the thumbnail of an image file in the requested size"""
+    key = thumbnails.thumbnail_key(file)
+    size = thumbnails.pick_size(request.args.get('size', THUMBNAIL_SIZES[1], type=int))
+    image_format = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    path = thumbnails.thumbnail_path(key, size, image_format)
+
+    # Rendered thumbnails are on disk already, only others need their status
+    if not os.path.exists(path):
+        status = get_thumbnail_status(key)
+
+        if status == 'ready':
+            # Removed from disk since, render it again
+            forget_thumbnails(key, 'ready')
+            status = None
+
+        if status == 'failed':
+            # Fallback to original image, rendering is retried after a while
+            thumbnails.request_thumbnails(file)
+            return send_stored_file(file)
+
+        if status != 'ready':
+            # Placeholder until a worker is done, fetched again next time
+            thumbnails.request_thumbnails(file)
+            response = send_file(os.path.join(app.static_folder, 'img', 'thumbnail-pending.svg'),
+                                 mimetype='image/svg+xml', conditional=False)
+            response.cache_control.no_store = True
+            return response
+
+    response = send_stored_file(file, path, f'image/{image_format}')
+    response.vary.add('Accept')
+    return response
 
 
 @app.route('/upload', methods=['POST'])
@@ -261,9 +514,9 @@ def upload():
     user = get_user_by_id(user_id)
 
     # Get folder from form data
-    folder = request.form.get('folder', '')
+    folder = normalize_folder_path(request.form.get('folder', ''))
 
-    print(f"DEBUG: Uploading file. User: {user_id}, Folder: '{folder}'")
+    logger.debug('Uploading file', extra={'user_id': user_id, 'folder': folder})
 
     # Check if file was uploaded
     if 'file' not in request.files:
@@ -278,10 +531,8 @@ def upload():
     if not allowed_file(file.filename):
         return jsonify({'error': 'File type not allowed'}), 400
 
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
+    # The file was hashed while the request was parsed
+    temp_path, content_hash, file_size = file.stream.finish()
 
     # Check storage limit
     used_storage = get_user_storage_usage(user_id)
@@ -293,6 +544,11 @@ def upload():
     if original_filename is None:
         return jsonify({'error': 'Invalid filename'}), 400
 
+    return save_uploaded_file(user_id, original_filename, folder, file_size, content_hash, temp_path)
+
+
+def describe_upload(original_filename):
+    """Get the stored name, unique name, type and MIME type of an upload"""
     secured_filename = secure_filename(original_filename)
     file_extension = os.path.splitext(secured_filename)[1].lower()
     file_type = file_extension[1:] if file_extension else 'unknown'
@@ -300,34 +556,60 @@ def upload():
     # Generate unique filename
     unique_filename = f"{uuid.uuid4().hex}{file_extension}"
 
-    # Create user upload directory with optional folder
-    if folder:
-        user_upload_dir = os.path.join(UPLOAD_FOLDER, str(user_id), folder)
-    else:
-        user_upload_dir = os.path.join(UPLOAD_FOLDER, str(user_id))
+    # Get MIME type
+    mime_type = mimetypes.guess_type(secured_filename)[0] or 'application/octet-stream'
 
-    filepath = os.path.join(user_upload_dir, unique_filename)
+    return secured_filename, unique_filename, file_type, mime_type
 
-    print(f"DEBUG: Saving file to: {filepath}")
 
-    # Ensure directory exists
-    os.makedirs(user_upload_dir, exist_ok=True)
+def save_uploaded_file(user_id, original_filename, folder, file_size, content_hash, temp_path=None):
+    """Register an upload and move its bytes into the blob store
 
-    # Save file
-    try:
-        file.save(filepath)
-    except Exception as e:
-        print(f"ERROR: Failed to save file: {e}")
-        return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
+    Without a temp_path the blob must already be stored, so the file is
+    added without any bytes being transferred.
+    """
+    secured_filename, unique_filename, file_type, mime_type = describe_upload(original_filename)
+    ensure_folder(user_id, folder)
 
-    # Get MIME type
-    mime_type = mimetypes.guess_type(secured_filename)[0] or 'application/octet-stream'
+    # Identical content is stored once, whoever uploads it
+    filepath = blobstore.blob_key(content_hash)
+
+    logger.debug('Saving file', extra={'user_id': user_id, 'key': filepath})
+
+    # Stored content keeps its encoding, only new blobs are compressed
+    encoding, stored_size = None, file_size
+    if temp_path and not get_blob(content_hash):
+        temp_path, encoding, stored_size = blobstore.encode_upload(temp_path, mime_type, file_size)
 
     # Add to database with folder info
     file_id = add_file(user_id, unique_filename, secured_filename,
-                       filepath, file_size, file_type, mime_type, folder)
+                       filepath, file_size, file_type, mime_type, folder,
+                       content_hash, blob_must_exist=temp_path is None,
+                       encoding=encoding, stored_size=stored_size)
+
+    # Quota is enforced again atomically with the insert
+    if file_id is None:
+        if temp_path:
+            blobstore.discard(temp_path)
+        return jsonify({'error': 'Storage limit exceeded'}), 400
+
+    blob_encoding = get_blob(content_hash)['encoding']
 
-    print(f"DEBUG: File saved with ID: {file_id}")
+    # Place the blob only once it is referenced, see delete_file
+    if temp_path:
+        try:
+            blobstore.commit_blob(temp_path, content_hash, encoding, blob_encoding)
+        except Exception as e:
+            logger.exception('Failed to save file', extra={'user_id': user_id, 'file_id': file_id})
+            delete_file(file_id, user_id)
+            return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
+
+    logger.info('File saved', extra={'user_id': user_id, 'file_id': file_id, 'size': file_size})
+
+    # Thumbnails are ready by the time the dashboard asks for them
+    if is_image_file(file_type, mime_type):
+        thumbnails.request_thumbnails({'id': file_id, 'content_hash': content_hash, 'filepath': filepath,
+                                       'encoding': blob_encoding})
 
     return jsonify({
         'success': True,
@@ -339,73 +621,579 @@ def upload():
     })
 
 
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Handle many files in one request, stored in one transaction"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    folder = normalize_folder_path(request.form.get('folder', ''))
+    files = request.files.getlist('files')
+
+    logger.debug('Uploading batch', extra={'user_id': user_id, 'folder': folder, 'count': len(files)})
+
+    if not files:
+        return jsonify({'error': 'No file part'}), 400
+
+    if len(files) > UPLOAD_BATCH_MAX_FILES:
+        return jsonify({'error': f'At most {UPLOAD_BATCH_MAX_FILES} files per batch'}), 400
+
+    # Every file was streamed to disk and hashed while the request was parsed
+    accepted = []
+    rejected = []
+    for file in files:
+        temp_path, content_hash, file_size = file.stream.finish()
+
+        if not file.filename or not allowed_file(file.filename):
+            rejected.append({'filename': file.filename, 'error': 'File type not allowed'})
+            continue
+
+        secured_filename, unique_filename, file_type, mime_type = describe_upload(file.filename)
+        encoding, stored_size = None, file_size
+        if not get_blob(content_hash):
+            temp_path, encoding, stored_size = blobstore.encode_upload(temp_path, mime_type, file_size)
+
+        accepted.append({
+            'filename': unique_filename,
+            'original_filename': secured_filename,
+            'filepath': blobstore.blob_key(content_hash),
+            'file_size': file_size,
+            'file_type': file_type,
+            'mime_type': mime_type,
+            'folder': folder,
+            'content_hash': content_hash,
+            'encoding': encoding,
+            'stored_size': stored_size,
+            'temp_path': temp_path
+        })
+
+    # One quota check and one transaction for the whole batch
+    file_ids = add_files(user_id, accepted) if accepted else []
+    if file_ids is None:
+        return jsonify({'error': 'Storage limit exceeded'}), 400
+
+    ensure_folder(user_id, folder)
+
+    # Place the blobs only once they are referenced, see delete_file
+    try:
+        for entry in accepted:
+            blob_encoding = get_blob(entry['content_hash'])['encoding']
+            blobstore.commit_blob(entry['temp_path'], entry['content_hash'], entry['encoding'], blob_encoding)
+            entry['temp_path'] = None
+            entry['blob_encoding'] = blob_encoding
+    except Exception as e:
+        logger.exception('Failed to save batch', extra={'user_id': user_id, 'files': len(file_ids)})
+        # The rows were committed together, so they go together
+        delete_files(user_id, file_ids)
+        reaper.storage_reaper.wake()
+        for entry in accepted:
+            if entry['temp_path']:
+                blobstore.discard(entry['temp_path'])
+        return jsonify({'error': f'Failed to save files: {str(e)}'}), 500
+
+    uploaded = []
+    for file_id, entry in zip(file_ids, accepted):
+        blob_encoding = entry['blob_encoding']
+
+        is_image = is_image_file(entry['file_type'], entry['mime_type'])
+        if is_image:
+            thumbnails.request_thumbnails({'id': file_id, 'content_hash': entry['content_hash'],
+                                           'filepath': entry['filepath'], 'encoding': blob_encoding})
+
+        uploaded.append({
+            'file_id': file_id,
+            'filename': entry['original_filename'],
+            'file_size': format_file_size(entry['file_size']),
+            'is_image': is_image
+        })
+
+    logger.info('Batch saved', extra={'user_id': user_id, 'saved': len(uploaded), 'rejected': len(rejected)})
+
+    return jsonify({
+        'success': True,
+        'files': uploaded,
+        'rejected': rejected,
+        'folder': folder
+    })
+
+
+def remove_upload_session(upload):
+    """Drop a chunked upload and its temporary file"""
+    try:
+        os.remove(upload['temp_path'])
+    except OSError:
+        pass
+    delete_upload_session(upload['id'])
+
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    """Start a chunked, resumable upload"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or request.form
+
+    filename = data.get('filename', '')
+    folder = normalize_folder_path(data.get('folder', ''))
+    try:
+        file_size = int(data.get('size', -1))
+    except (TypeError, ValueError):
+        file_size = -1
+
+    if not filename:
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    if file_size < 0 or file_size > UPLOAD_MAX_FILE_SIZE:
+        return jsonify({'error': 'Invalid file size'}), 400
+
+    # Content the store already holds needs no body at all
+    content_hash = (data.get('sha256') or '').lower()
+    if BLOB_CLIENT_HASH_DEDUP and re.fullmatch(r'[0-9a-f]{64}', content_hash):
+        blob = get_blob(content_hash)
+        if blob and blob['size'] == file_size:
+            return save_uploaded_file(user_id, filename, folder, file_size, content_hash)
+
+    # Abandoned uploads stop holding quota and disk space
+    for expired in get_expired_upload_sessions(UPLOAD_SESSION_TTL):
+        remove_upload_session(expired)
+
+    upload_id = uuid.uuid4().hex
+    temp_path = os.path.join(UPLOAD_TMP_FOLDER, upload_id)
+
+    if not create_upload_session(upload_id, user_id, filename, folder,
+                                 file_size, UPLOAD_CHUNK_SIZE, temp_path):
+        return jsonify({'error': 'Storage limit exceeded'}), 400
+
+    # Sparse file that chunks are written into at their offsets
+    with open(temp_path, 'wb') as f:
+        f.truncate(file_size)
+
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'chunk_size': UPLOAD_CHUNK_SIZE
+    })
+
+
+@app.route('/upload/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_chunk(upload_id):
+    """Report, receive a chunk of, or cancel a chunked upload"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    upload = get_upload_session(upload_id, session['user_id'])
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    if request.method == 'GET':
+        # Lets a client resume by sending only the missing chunks
+        return jsonify({
+            'upload_id': upload_id,
+            'size': upload['file_size'],
+            'chunk_size': upload['chunk_size'],
+            'received': get_upload_chunks(upload_id)
+        })
+
+    if request.method == 'DELETE':
+        remove_upload_session(upload)
+        return jsonify({'success': True})
+
+    offset = request.args.get('offset', -1, type=int)
+    chunk_size = upload['chunk_size']
+    if offset < 0 or offset % chunk_size or offset >= max(upload['file_size'], 1):
+        return jsonify({'error': 'Invalid offset'}), 400
+
+    # Every chunk but the last one is exactly chunk_size long
+    expected = min(chunk_size, upload['file_size'] - offset)
+    if request.content_length != expected:
+        return jsonify({'error': f'Chunk must be {expected} bytes'}), 400
+
+    # Stream the body straight to disk without buffering the chunk
+    received = 0
+    with open(upload['temp_path'], 'r+b') as f:
+        f.seek(offset)
+        while received < expected:
+            block = request.stream.read(min(UPLOAD_STREAM_BLOCK_SIZE, expected - received))
+            if not block:
+                break
+            f.write(block)
+            received += len(block)
+
+    if received != expected:
+        return jsonify({'error': 'Incomplete chunk'}), 400
+
+    if not add_upload_chunk(upload_id, offset // chunk_size):
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'offset': offset, 'size': received})
+
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    """Finish a chunked upload once every chunk has arrived"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    upload = get_upload_session(upload_id, user_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    chunk_count = -(-upload['file_size'] // upload['chunk_size'])
+    if len(get_upload_chunks(upload_id)) != chunk_count:
+        return jsonify({'error': 'Upload is incomplete'}), 400
+
+    # Only one of concurrent completions gets to save the file
+    upload = claim_upload_session(upload_id, user_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    # Chunks may arrive in any order, so hash the assembled file once
+    content_hash = blobstore.hash_file(upload['temp_path'])
+
+    response = save_uploaded_file(user_id, upload['original_filename'], upload['folder'],
+                                  upload['file_size'], content_hash, upload['temp_path'])
+    blobstore.discard(upload['temp_path'])
+    return response
+
+
+@app.route('/api/files/<int:file_id>/signature')
+def file_signature(file_id):
+    """Block checksums of a file, for sending a new version as a delta"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    file = get_file_by_id(file_id, session['user_id'])
+    if not file:
+        return jsonify({'error': 'File not found'}), 404
+
+    try:
+        block_size, signature = delta.get_signature(file)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+
+    return jsonify({
+        'file_id': file_id,
+        'size': file['file_size'],
+        'sha256': file['content_hash'],
+        'block_size': block_size,
+        'blocks': delta.unpack_signature(signature)
+    })
+
+
+@app.route('/api/files/<int:file_id>/delta', methods=['POST'])
+def upload_delta(file_id):
+    """Store a new version of a file from the blocks that changed
+
+    Takes the instructions, the literal bytes they use as the 'data' file
+    and the SHA-256 of the result, see delta.py. The new version is added
+    like an upload next to the old one, which 'replace' deletes.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    base = get_file_by_id(file_id, user_id)
+    if not base:
+        return jsonify({'error': 'File not found'}), 404
+
+    expected_hash = request.form.get('sha256', '').lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', expected_hash):
+        return jsonify({'error': 'sha256 of the new version is required'}), 400
+
+    filename = request.form.get('filename') or base['original_filename']
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    folder = normalize_folder_path(request.form.get('folder', base['folder']))
+
+    literal = request.files.get('data')
+    literal_stream = literal.stream if literal else io.BytesIO()
+    literal_size = literal_stream.size if literal else 0
+
+    try:
+        steps = delta.parse_instructions(request.form.get('instructions', ''), base['file_size'],
+                                         delta.block_size_for(base['file_size']), literal_size)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Removed at the end of the request unless it makes it into the store
+    target = blobstore.HashingTempFile()
+    request.upload_temp_files.append(target)
+    literal_stream.seek(0)
+    try:
+        with blobstore.open_blob(base['filepath'], base['encoding']) as source:
+            delta.apply_delta(source, literal_stream, steps, target)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    except (ValueError, EOFError):
+        # The stored copy is shorter than its row says or its gzip is cut off
+        return jsonify({'error': 'Stored file cannot be rebuilt from, upload it whole'}), 409
+    temp_path, content_hash, file_size = target.finish()
+
+    if content_hash != expected_hash:
+        return jsonify({'error': 'Rebuilt file does not match sha256, upload it whole'}), 409
+
+    logger.info('Delta received', extra={'user_id': user_id, 'base_id': file_id, 'size': file_size,
+                                         'sent': literal_size})
+
+    response = save_uploaded_file(user_id, filename, folder, file_size, content_hash, temp_path)
+    # Failures come back as (response, status) tuples
+    if not isinstance(response, tuple) and request.form.get('replace') in ('1', 'true'):
+        delete_file(file_id, user_id)
+        reaper.storage_reaper.wake()
+    return response
+
+
 @app.route('/download/<int:file_id>')
 def download(file_id: int) -> Union[Response, None]:
     """Download a file"""
     user_id = session.get('user_id')
 
-    # Check if user owns the file or file is public
+    # Check if user owns the file or came with a share link to it
     file = get_file_by_id(file_id)
     if not file:
         abort(404)
 
-    if file['user_id'] != user_id and not file['is_public']:
+    link = shared_link_for(file)
+    if file['user_id'] != user_id and not link:
         abort(403)
 
-    # Increment download count if public
-    if file['is_public']:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE files SET download_count = download_count + 1 WHERE id = ?',
-            (file_id,)
-        )
-        conn.commit()
-        conn.close()
-
-    return send_file(
-        file['filepath'],
+    # Count downloads through share links, per link
+    if link:
+        increment_download_count(file_id, link['id'])
+
+    # Ranges let clients resume downloads and seek in videos
+    return send_stored_file(
+        file,
         as_attachment=True,
         download_name=file['original_filename']
     )
 
 
+@app.route('/download-folder')
+def download_folder():
+    """Download a folder or a selection of files as one ZIP archive"""
+    if 'user_id' not in session:
+        return redirect(url_for('auth_page'))
+
+    user_id = session['user_id']
+    folder = normalize_folder_path(request.args.get('folder', ''))
+    ids = request.args.get('ids', '')
+
+    if ids:
+        # Selection from the file list, may span folders
+        try:
+            selected = {int(file_id) for file_id in ids.split(',')}
+        except ValueError:
+            abort(400)
+        if len(selected) > ARCHIVE_MAX_FILES:
+            return jsonify({'error': f'At most {ARCHIVE_MAX_FILES} files per archive'}), 400
+        files = get_user_files_by_ids(user_id, selected)
+        folder = ''
+        archive_filename = 'files.zip'
+    else:
+        # Subfolders are included, as folders in the archive
+        files = get_user_files(user_id, folder, recursive=True)
+        archive_filename = f"{folder.rpartition('/')[2] or 'files'}.zip"
+
+    if not files:
+        abort(404)
+
+    if len(files) > ARCHIVE_MAX_FILES:
+        return jsonify({'error': f'At most {ARCHIVE_MAX_FILES} files per archive'}), 400
+
+    logger.info('Streaming archive', extra={'user_id': user_id, 'folder': folder, 'count': len(files)})
+
+    # Built while it's sent, the size isn't known up front
+    response = Response(archive.stream_zip(files, folder), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{secure_filename(archive_filename)}"'
+    response.cache_control.no_store = True
+    return response
+
+
 @app.route('/delete/<int:file_id>', methods=['POST'])
 def delete(file_id):
     """Delete a file"""
     user_id = session['user_id']
 
     if delete_file(file_id, user_id):
+        reaper.storage_reaper.wake()
         return jsonify({'success': True})
     else:
         return jsonify({'error': 'File not found or permission denied'}), 404
 
 
-@app.route('/share/<int:file_id>', methods=['POST', 'DELETE'])
+@app.route('/delete-batch', methods=['POST'])
+def delete_batch():
+    """Delete many files in one request"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    data = request.get_json(silent=True) or {}
+    file_ids = data.get('file_ids')
+    if not isinstance(file_ids, list) or not all(isinstance(file_id, int) for file_id in file_ids):
+        return jsonify({'error': 'file_ids must be a list of ids'}), 400
+
+    deleted = delete_files(user_id, file_ids)
+    reaper.storage_reaper.wake()
+
+    logger.info('Deleted files', extra={'user_id': user_id, 'deleted': deleted, 'requested': len(file_ids)})
+
+    return jsonify({'success': True, 'deleted': deleted})
+
+
+@app.route('/delete-folder', methods=['POST'])
+def delete_folder():
+    """Delete a folder with its subfolders and files"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    path = normalize_folder_path(request.form.get('folder', ''))
+
+    deleted = delete_user_folder(user_id, path)
+    if deleted is None:
+        return jsonify({'error': 'Folder not found'}), 404
+    reaper.storage_reaper.wake()
+
+    logger.info('Deleted folder', extra={'user_id': user_id, 'folder': path, 'deleted': deleted})
+
+    return jsonify({'success': True, 'deleted': deleted})
+
+
+def shared_link_for(file):
+    """Get the live share link to a file the request came with, if any"""
+    token = request.args.get('token')
+    link = get_share_link(token) if token else None
+    return link if link and link['file_id'] == file['id'] else None
+
+
+@app.route('/share/<int:file_id>', methods=['GET', 'POST', 'DELETE'])
 def share(file_id):
-    """Share or unshare a file"""
+    """List, create or remove share links of a file
+
+    A file can have several links, each optionally expiring after
+    `expires_in` seconds. DELETE removes the link given as `token`, or
+    every link of the file.
+    """
     user_id = session['user_id']
+    data = request.get_json(silent=True) or request.values
+
+    if request.method == 'GET':
+        if not get_file_by_id(file_id, user_id):
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'links': [{
+            'token': link['token'],
+            'share_url': url_for('public_file', token=link['token'], _external=True),
+            'created_at': link['created_at'],
+            'expires_at': link['expires_at'],
+            'download_count': link['download_count']
+        } for link in get_share_links(file_id, user_id)]})
 
     if request.method == 'POST':
-        # Create share token
-        token = create_share_token(file_id)
+        try:
+            expires_in = int(data.get('expires_in') or 0)
+        except (TypeError, ValueError):
+            expires_in = -1
+        if expires_in < 0:
+            return jsonify({'error': 'expires_in must be a number of seconds'}), 400
+
+        token = create_share_token(file_id, user_id, expires_in or None)
+        if token is None:
+            return jsonify({'error': 'File not found'}), 404
         share_url = url_for('public_file', token=token, _external=True)
         return jsonify({'success': True, 'share_url': share_url, 'token': token})
 
     elif request.method == 'DELETE':
         # Disable sharing
-        disable_share_token(file_id, user_id)
-        return jsonify({'success': True})
+        tokens = disable_share_token(file_id, user_id, data.get('token'))
+        for token in tokens:
+            share_page_cache.invalidate(token)
+        return jsonify({'success': True, 'disabled': len(tokens)})
+
+
+# Rendered share pages by token. Pages are only served while their link
+# and file resolve, so unsharing or deleting takes effect at once.
+share_page_cache = RowCache('share_pages', SHARE_PAGE_CACHE_SIZE, SHARE_PAGE_CACHE_TTL)
+
+
+def resolve_share(token):
+    """Get the live link of a token and its file, usually from memory"""
+    link = get_share_link(token)
+    file = get_file_by_id(link['file_id']) if link else None
+    return (link, file) if file else (None, None)
+
+
+def share_preview(file, token):
+    """Get what a share page shows of a file inline, None for an icon"""
+    if not file['mime_type'].startswith(SHARE_INLINE_MIME_TYPES):
+        return None
+    if is_image_file(file['file_type'], file['mime_type']):
+        return {'kind': 'image', 'url': url_for('shared_thumbnail', token=token, size=THUMBNAIL_SIZES[-1])}
+    if file['mime_type'].startswith('video/'):
+        return {'kind': 'video', 'url': url_for('shared_raw', token=token, inline=1)}
+    return None
 
 
 @app.route('/public/<token>')
 def public_file(token):
     """Public file access"""
-    file = get_public_file(token)
+    link, file = resolve_share(token)
+    if not file:
+        abort(404)
+
+    page = share_page_cache.get(token)
+    if page is None:
+        page = render_template('share.html', file=file, link=link, token=token,
+                               preview=share_preview(file, token))
+        share_page_cache.set(token, page)
+
+    # Shared caches may keep the page too, never past the link's expiry
+    max_age = SHARE_PAGE_MAX_AGE
+    if link['expires_at']:
+        expires_at = calendar.timegm(time.strptime(link['expires_at'], '%Y-%m-%d %H:%M:%S'))
+        max_age = max(0, min(max_age, int(expires_at - time.time())))
+
+    response = Response(page, mimetype='text/html')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+@app.route('/s/<token>/raw')
+def shared_raw(token):
+    """Download a shared file straight from its link
+
+    With `inline` images and videos are shown in the browser instead, see
+    SHARE_INLINE_MIME_TYPES.
+    """
+    link, file = resolve_share(token)
     if not file:
         abort(404)
 
-    return render_template('share.html', file=file, token=token)
+    # Players and resumed downloads ask for ranges, count each download once
+    if request.range is None or request.range.ranges[0][0] == 0:
+        increment_download_count(file['id'], link['id'])
+
+    inline = bool(request.args.get('inline')) and file['mime_type'].startswith(SHARE_INLINE_MIME_TYPES)
+    return send_stored_file(file, as_attachment=not inline, download_name=file['original_filename'])
+
+
+@app.route('/s/<token>/thumbnail')
+def shared_thumbnail(token):
+    """Thumbnail of a shared image, for its share page"""
+    link, file = resolve_share(token)
+    if not file or not is_image_file(file['file_type'], file['mime_type']):
+        abort(404)
+
+    return send_thumbnail(file)
 
 
 @app.route('/logout')
@@ -435,29 +1223,56 @@ def api_storage():
     })
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics of this process in the Prometheus text format"""
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            abort(403)
+    elif request.remote_addr not in ('127.0.0.1', '::1') or any(
+            header in request.headers for header in ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')):
+        # A proxy on this host relays everyone's requests from localhost
+        abort(403)
+
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/image/<int:file_id>')
 def image_preview(file_id):
     """Serve image file for preview"""
     user_id = session.get('user_id')
 
-    # Check if user owns the file or file is public
+    # Check if user owns the file or came with a share link to it
     file = get_file_by_id(file_id)
     if not file:
         abort(404)
 
-    if file['user_id'] != user_id and not file['is_public']:
+    if file['user_id'] != user_id and not shared_link_for(file):
         abort(403)
 
     # Check if file is an image
     if not is_image_file(file['file_type'], file['mime_type']):
         abort(404)
 
-    # Add cache control headers
-    response = send_file(file['filepath'])
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    # Cached for good by the browser, the ETag covers revalidation
+    return send_stored_file(file)
+
+
+@app.cli.command('reconcile-storage')
+def reconcile_storage_command():
+    """Rebuild per-user storage counters from the files table"""
+    updated = reconcile_storage_usage()
+    print(f"Reconciled storage usage for {updated} users")
+
+
+@app.cli.command('collect-garbage')
+def collect_garbage_command():
+    """Reap deleted files and run a whole orphan collector pass now"""
+    reaped = reaper.reap_deleted()
+    batches = reaper.collect_all_orphans()
+    print(f"Reaped {reaped} deleted files, collector pass took {batches} batches")
+
 
 if __name__ == '__main__':
+    configure_logging()
     app.run(debug=True, host="0.0.0.0", port=5000)
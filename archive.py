@@ -0,0 +1,109 @@
+import os
+import zipfile
+from datetime import datetime
+
+import blobstore
+from config import ARCHIVE_STORED_TYPES, UPLOAD_STREAM_BLOCK_SIZE
+from logs import get_logger
+
+logger = get_logger('archive')
+
+
+class _ZipOutput:
+    """Write-only sink that collects what zipfile writes until it's taken
+
+    It can't seek, so zipfile writes sizes and checksums after each member
+    and the archive can be sent while it's being built.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Get everything written since the last call"""
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def archive_name(file, folder, used_names):
+    """Get a unique path for a file inside an archive of a folder"""
+    name = file['original_filename']
+    if file['folder'] and file['folder'] != folder:
+        # Paths below the archived folder are kept relative to it
+        subfolder = file['folder']
+        if folder and subfolder.startswith(folder + '/'):
+            subfolder = subfolder[len(folder) + 1:]
+        name = f"{subfolder}/{name}"
+
+    # Files can share a name, zip members shouldn't
+    base, extension = os.path.splitext(name)
+    candidate = name
+    counter = 1
+    while candidate in used_names:
+        candidate = f'{base} ({counter}){extension}'
+        counter += 1
+
+    used_names.add(candidate)
+    return candidate
+
+
+def stream_zip(files, folder=''):
+    """Generate a ZIP archive of stored files block by block
+
+    Nothing is buffered beyond one block, so memory use doesn't depend on
+    the size of the archive.
+    """
+    output = _ZipOutput()
+    used_names = set()
+
+    with zipfile.ZipFile(output, 'w', allowZip64=True) as archive:
+        for file in files:
+            try:
+                source = blobstore.open_blob(file['filepath'], file['encoding'])
+            except FileNotFoundError:
+                logger.warning('Skipping missing file in archive', extra={'file_id': file['id']})
+                continue
+
+            info = zipfile.ZipInfo(archive_name(file, folder, used_names), _zip_date(file['uploaded_at']))
+            info.file_size = file['file_size']
+            info.external_attr = 0o644 << 16
+
+            # Images, video and archives don't get smaller, skip the CPU work
+            if file['file_type'] in ARCHIVE_STORED_TYPES:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+
+            with source, archive.open(info, 'w') as member:
+                while True:
+                    block = source.read(UPLOAD_STREAM_BLOCK_SIZE)
+                    if not block:
+                        break
+                    member.write(block)
+
+                    data = output.take()
+                    if data:
+                        yield data
+
+            # Rest of the member and its data descriptor
+            yield output.take()
+
+    # Central directory
+    yield output.take()
+
+
+def _zip_date(uploaded_at):
+    """Get a ZIP timestamp from a stored upload time"""
+    try:
+        date = datetime.strptime(str(uploaded_at)[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        date = datetime.now()
+    return max(date.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
@@ -0,0 +1,251 @@
+"""Production entry point, serving the Flask app over ASGI
+
+    python asgi.py
+    uvicorn asgi:application --workers 4
+
+Views stay synchronous and run on a bounded thread pool, but nothing
+waits on a client while holding a thread: request bodies are received on
+the event loop before the view runs, and response bodies are produced a
+block at a time on the pool and sent from the loop. A slow transfer then
+costs a coroutine and its buffers instead of a thread, so one process
+holds thousands of them.
+"""
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (UPLOAD_TMP_FOLDER, UPLOAD_STREAM_BLOCK_SIZE, MAX_CONTENT_LENGTH, ASGI_THREADS,
+                    ASGI_SPOOL_MAX_MEMORY, SERVER_HOST, SERVER_PORT, SERVER_WORKERS)
+from app import app
+from logs import configure_logging, get_logger
+
+logger = get_logger('asgi')
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='wsgi')
+
+
+class FileWrapper:
+    """wsgi.file_wrapper reading UPLOAD_STREAM_BLOCK_SIZE blocks
+
+    Each block is read on the thread pool, so reads never stall the loop.
+    """
+
+    def __init__(self, file, block_size=UPLOAD_STREAM_BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        block = self.file.read(self.block_size)
+        if not block:
+            raise StopIteration
+        return block
+
+    def close(self):
+        if hasattr(self.file, 'close'):
+            self.file.close()
+
+
+def build_environ(scope, body, content_length):
+    """Get the WSGI environ of an ASGI HTTP request"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(content_length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': SERVER_WORKERS > 1,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+            # The body is complete by now, its length is known
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    return environ
+
+
+async def receive_body(receive, loop):
+    """Receive a request body into a spooled file, None if it's too large
+
+    Bodies up to ASGI_SPOOL_MAX_MEMORY stay in memory, larger ones go to
+    UPLOAD_TMP_FOLDER with the writes done on the thread pool.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_MAX_MEMORY, dir=UPLOAD_TMP_FOLDER)
+    size = 0
+    pending = []
+    pending_size = 0
+    more_body = True
+    try:
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                raise ConnectionAbortedError('client disconnected during the request body')
+
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            size += len(chunk)
+            if size > MAX_CONTENT_LENGTH:
+                body.close()
+                return None, size
+
+            # Batch small chunks into one write per block
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= UPLOAD_STREAM_BLOCK_SIZE or not more_body:
+                await loop.run_in_executor(_executor, body.write, b''.join(pending))
+                pending = []
+                pending_size = 0
+
+        body.seek(0)
+        return body, size
+    except BaseException:
+        body.close()
+        raise
+
+
+def run_view(environ):
+    """Call the WSGI app, returns its status, headers and body iterator"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        started['status'] = status
+        started['headers'] = headers
+        return written.append
+
+    written = []
+    result = app(environ, start_response)
+    iterator = iter(result)
+    # start_response may only be called once the first block is asked for
+    first = next(iterator, None)
+    return started['status'], started['headers'], result, iterator, written + ([first] if first else [])
+
+
+async def watch_disconnect(receive):
+    """Return once the client goes away"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_response(send, loop, status, headers, iterator, first_blocks):
+    """Send a response, producing each block on the pool
+
+    Only the loop's buffers are held while a slow client catches up.
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    for block in first_blocks:
+        await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+
+    while True:
+        production = loop.run_in_executor(_executor, next, iterator, None)
+        try:
+            block = await asyncio.shield(production)
+        except asyncio.CancelledError:
+            # The body can't be closed while a block is being produced
+            await asyncio.wait((production,))
+            raise
+        if block is None:
+            break
+        if block:
+            await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def handle_http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    try:
+        body, size = await receive_body(receive, loop)
+    except ConnectionAbortedError:
+        return
+
+    if body is None:
+        await send({'type': 'http.response.start', 'status': 413,
+                    'headers': [(b'content-type', b'text/plain'), (b'connection', b'close')]})
+        await send({'type': 'http.response.body', 'body': b'Request Entity Too Large'})
+        return
+
+    result = None
+    try:
+        environ = build_environ(scope, body, size)
+        status, headers, result, iterator, first_blocks = await loop.run_in_executor(
+            _executor, run_view, environ
+        )
+
+        # Sending to a client that went away may never return, stop then
+        sending = asyncio.ensure_future(send_response(send, loop, status, headers, iterator, first_blocks))
+        watcher = asyncio.ensure_future(watch_disconnect(receive))
+        await asyncio.wait((sending, watcher), return_when=asyncio.FIRST_COMPLETED)
+        watcher.cancel()
+        if not sending.done():
+            sending.cancel()
+        await asyncio.gather(sending, watcher, return_exceptions=True)
+    finally:
+        if result is not None and hasattr(result, 'close'):
+            await loop.run_in_executor(_executor, result.close)
+        await loop.run_in_executor(_executor, body.close)
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI entry point of the app"""
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+    else:
+        raise ValueError(f"Unsupported scope type: {scope['type']}")
+
+
+def main():
+    import uvicorn
+
+    configure_logging()
+    logger.info('Starting server', extra={'host': SERVER_HOST, 'port': SERVER_PORT, 'workers': SERVER_WORKERS})
+    uvicorn.run('asgi:application', host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS,
+                proxy_headers=True, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,492 @@
+"""Benchmark the hot paths of the app in-process, against scratch storage
+
+    python benchmark.py --users 4 --files-per-user 200 --output results.json
+    python benchmark.py --baseline results.json   # exits 1 on a regression
+    python benchmark.py --server --concurrency 8 --scenarios dashboard,upload
+
+Requests go through the WSGI test client, so numbers cover the app,
+SQLite and the disk but not a server or the network. With --server they
+go over HTTP to a threaded WSGI server on a local port instead, so
+concurrent clients are served by concurrent threads. DATABASE_PATH and
+UPLOAD_FOLDER point at a temporary directory, removed afterwards unless
+--keep is given.
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+SCENARIOS = ('login', 'dashboard', 'files', 'files_cursor', 'upload', 'download', 'thumbnail', 'public', 'drop_single', 'drop_batch',
+             'serve_send_file', 'serve_x_sendfile', 'serve_x_accel')
+# Downloads of a large file with each FILE_SERVING_BACKEND. No proxy runs
+# here, so the offload backends answer with the header alone: they show
+# how long a worker is held per download, not how fast bytes arrive.
+SERVING_SCENARIOS = {
+    'serve_send_file': 'send_file',
+    'serve_x_sendfile': 'x-sendfile',
+    'serve_x_accel': 'x-accel-redirect',
+}
+
+PASSWORD = 'benchmark-password'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark login, dashboard, file list, upload, download, '
+                                                 'thumbnail, public share, folder drop and file serving '
+                                                 'requests.')
+    parser.add_argument('--users', type=int, default=4, help='synthetic users to seed')
+    parser.add_argument('--files-per-user', type=int, default=100, help='files seeded per user')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per seeded file')
+    parser.add_argument('--images-per-user', type=int, default=5, help='of those, images with thumbnails')
+    parser.add_argument('--upload-size', type=int, default=256 * 1024, help='bytes per benchmarked upload')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--login-requests', type=int, default=20,
+                        help='requests for the login scenario, password hashing is slow on purpose')
+    parser.add_argument('--serve-file-size', type=int, default=8 * 1024 * 1024,
+                        help='bytes of the file downloaded by the serve scenarios')
+    parser.add_argument('--drop-files', type=int, default=1000, help='files in one folder drop')
+    parser.add_argument('--drop-file-size', type=int, default=1024, help='bytes per dropped file')
+    parser.add_argument('--drop-requests', type=int, default=3,
+                        help='drops for the drop scenarios, each one uploads --drop-files files')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests before each scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='threads sending requests')
+    parser.add_argument('--server', action='store_true',
+                        help='send requests over HTTP to a threaded WSGI server instead of the test client')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0, help='random seed for file contents and picks')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to write results')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='allowed relative p99 increase or throughput drop against the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args(argv)
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed, queries):
+    """Turn per-request latencies of a scenario into its results"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput': round(count / elapsed, 2) if elapsed else 0.0,
+        'queries_per_request': round(queries / count, 2) if count else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / count * 1000, 3) if count else 0.0,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p90': round(percentile(latencies, 0.90) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3) if count else 0.0,
+        },
+    }
+
+
+def make_png(rng, size=800):
+    from PIL import Image
+
+    image = Image.new('RGB', (size, size * 3 // 4), tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class HttpClient:
+    """The parts of the test client the scenarios use, over HTTP to a server"""
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.cookies = {}
+
+    def open(self, path, method='GET', headers=None, **kwargs):
+        from werkzeug.test import EnvironBuilder
+        from werkzeug.wrappers import Response
+
+        # Encode the request, multipart bodies included, like the test client does
+        builder = EnvironBuilder(path=path, method=method, headers=headers, **kwargs)
+        try:
+            environ = builder.get_environ()
+            body = environ['wsgi.input'].read()
+            request_headers = dict(builder.headers)
+        finally:
+            builder.close()
+        if environ.get('CONTENT_TYPE'):
+            request_headers['Content-Type'] = environ['CONTENT_TYPE']
+        if self.cookies:
+            request_headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+
+        url = environ['PATH_INFO'] + ('?' + environ['QUERY_STRING'] if environ['QUERY_STRING'] else '')
+        self.connection.request(method, url, body, request_headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        for header in response.headers.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value.strip()
+        return Response(data, status=response.status, headers=response.getheaders())
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+
+class Benchmark:
+    """Seeded app instance and the scenarios run against it"""
+
+    def __init__(self, app_module, args):
+        self.app = app_module.app
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.users = []
+        self.server = None
+
+    def serve(self):
+        """Start a threaded WSGI server for the app on a free local port"""
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class RequestHandler(WSGIRequestHandler):
+            # Keep connections open between requests, like a browser
+            protocol_version = 'HTTP/1.1'
+
+            def log_request(self, *args):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True, request_handler=RequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def client(self, user=None):
+        if self.server is not None:
+            client = HttpClient(self.server.port)
+            if user is not None and not self.login(client, user):
+                raise RuntimeError(f"could not log in {user['username']}")
+            return client
+
+        client = self.app.test_client()
+        if user is not None:
+            with client.session_transaction() as session:
+                session['user_id'] = user['id']
+                session['username'] = user['username']
+        return client
+
+    def seed(self):
+        """Create users with files, images and one shared file each"""
+        from database import get_db, get_thumbnail_status
+
+        args = self.args
+        for index in range(args.users):
+            username = f'bench{index}'
+            client = self.app.test_client()
+            response = client.post('/auth', data={
+                'action': 'register', 'username': username, 'email': f'{username}@example.com',
+                'password': PASSWORD, 'confirm_password': PASSWORD,
+            })
+            if response.status_code != 302:
+                raise RuntimeError(f'could not register {username}')
+
+            user_id = get_db().execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()[0]
+            files = [(io.BytesIO(self.rng.randbytes(args.file_size)), f'file{number}.txt')
+                     for number in range(args.files_per_user - args.images_per_user)]
+            files += [(io.BytesIO(make_png(self.rng)), f'image{number}.png')
+                      for number in range(args.images_per_user)]
+
+            file_ids = []
+            image_ids = []
+            for start in range(0, len(files), 100):
+                response = client.post('/upload/batch', data={
+                    'files': files[start:start + 100], 'folder': f'seed/{start // 100}'
+                }, content_type='multipart/form-data')
+                for item in response.get_json()['files']:
+                    file_ids.append(item['file_id'])
+                    if item['is_image']:
+                        image_ids.append(item['file_id'])
+
+            token = None
+            if file_ids:
+                token = client.post(f'/share/{file_ids[0]}').get_json()['token']
+
+            # A cursor halfway down the file list, for a page deep in the index
+            cursors = []
+            cursor = client.get('/api/files').get_json()['next_cursor']
+            while cursor:
+                cursors.append(cursor)
+                cursor = client.get(f'/api/files?cursor={cursor}').get_json()['next_cursor']
+
+            # Video isn't compressed in storage, so every backend may serve it
+            large_id = None
+            if SERVING_SCENARIOS.keys() & set(args.scenarios):
+                response = client.post('/upload', data={
+                    'file': (io.BytesIO(self.rng.randbytes(args.serve_file_size)), 'large.mp4')
+                }, content_type='multipart/form-data')
+                large_id = response.get_json()['file_id']
+            self.users.append({'id': user_id, 'username': username, 'file_ids': file_ids,
+                               'image_ids': image_ids, 'token': token, 'large_id': large_id,
+                               'cursor': cursors[len(cursors) // 2] if cursors else None})
+
+        # Thumbnails render in the background, wait for them to be served
+        import thumbnails
+        from database import get_file_by_id
+
+        for user in self.users:
+            for file_id in user['image_ids']:
+                self.client(user).get(f'/thumbnail/{file_id}').close()
+        deadline = time.monotonic() + 120
+        keys = [thumbnails.thumbnail_key(get_file_by_id(file_id))
+                for user in self.users for file_id in user['image_ids']]
+        while keys and time.monotonic() < deadline:
+            keys = [key for key in keys if get_thumbnail_status(key) not in ('ready', 'failed')]
+            time.sleep(0.1)
+        if keys:
+            raise RuntimeError(f'{len(keys)} thumbnails were not rendered in time')
+
+    # Each scenario sends one request and returns whether it succeeded
+
+    def login(self, client, user):
+        response = client.post('/auth', data={'action': 'login', 'username': user['username'],
+                                              'password': PASSWORD})
+        return response.status_code == 302
+
+    def dashboard(self, client, user):
+        response = client.get('/dashboard')
+        response.get_data()
+        return response.status_code == 200
+
+    def files(self, client, user):
+        """First page of the file list, as the dashboard fetches it"""
+        response = client.get('/api/files')
+        return response.status_code == 200 and bool(response.get_json()['files'])
+
+    def files_cursor(self, client, user):
+        """A page further down the file list, continuing from a cursor"""
+        if not user['cursor']:
+            return False
+        response = client.get(f"/api/files?cursor={user['cursor']}")
+        return response.status_code == 200 and bool(response.get_json()['files'])
+
+    def upload(self, client, user):
+        data = self.rng.randbytes(self.args.upload_size)
+        response = client.post('/upload', data={'file': (io.BytesIO(data), 'upload.bin.txt'),
+                                                'folder': 'bench'},
+                               content_type='multipart/form-data')
+        return response.status_code == 200
+
+    def download(self, client, user):
+        if not user['file_ids']:
+            return False
+        response = client.get(f"/download/{self.rng.choice(user['file_ids'])}")
+        response.get_data()
+        response.close()
+        return response.status_code == 200
+
+    def thumbnail(self, client, user):
+        if not user['image_ids']:
+            return False
+        response = client.get(f"/thumbnail/{self.rng.choice(user['image_ids'])}?size=150",
+                              headers={'Accept': 'image/webp,*/*'})
+        response.get_data()
+        response.close()
+        return response.status_code == 200
+
+    def public(self, client, user):
+        if not user['token']:
+            return False
+        response = client.get(f"/public/{user['token']}")
+        response.get_data()
+        return response.status_code == 200
+
+    def serve_file(self, client, user):
+        """Download the large file, with the backend of the running serve scenario"""
+        response = client.get(f"/download/{user['large_id']}")
+        response.get_data()
+        response.close()
+        return response.status_code == 200
+
+    def drop_files(self):
+        """Contents of one folder drop"""
+        return [(io.BytesIO(self.rng.randbytes(self.args.drop_file_size)), f'drop{number}.txt')
+                for number in range(self.args.drop_files)]
+
+    def drop_single(self, client, user):
+        """A folder drop sent as one /upload per file, as before batching"""
+        for file in self.drop_files():
+            response = client.post('/upload', data={'file': file, 'folder': 'drop'},
+                                   content_type='multipart/form-data')
+            if response.status_code != 200:
+                return False
+        return True
+
+    def drop_batch(self, client, user):
+        """A folder drop sent through /upload/batch, as the dashboard does"""
+        from config import UPLOAD_BATCH_MAX_FILES
+
+        files = self.drop_files()
+        for start in range(0, len(files), UPLOAD_BATCH_MAX_FILES):
+            chunk = files[start:start + UPLOAD_BATCH_MAX_FILES]
+            response = client.post('/upload/batch', data={'files': chunk, 'folder': 'drop'},
+                                   content_type='multipart/form-data')
+            if response.status_code != 200 or len(response.get_json()['files']) != len(chunk):
+                return False
+        return True
+
+    def run_scenario(self, name):
+        """Send a scenario's requests from every thread, returns its results"""
+        import metrics
+
+        args = self.args
+        total = {'login': args.login_requests, 'drop_single': args.drop_requests,
+                 'drop_batch': args.drop_requests}.get(name, args.requests)
+        # A drop is thousands of requests already
+        warmup = 0 if name.startswith('drop_') else args.warmup
+        scenario = getattr(self, 'serve_file' if name in SERVING_SCENARIOS else name)
+        backend = None
+        if name in SERVING_SCENARIOS:
+            import serving
+            backend, serving.FILE_SERVING_BACKEND = serving.FILE_SERVING_BACKEND, SERVING_SCENARIOS[name]
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        counter = iter(range(total))
+
+        def worker(number):
+            user = self.users[number % len(self.users)]
+            # Share pages are fetched by visitors without a session
+            client = self.client() if name in ('login', 'public') else self.client(user)
+            for _ in range(warmup // args.concurrency):
+                scenario(client, user)
+            barrier.wait()
+
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+                started = time.perf_counter()
+                try:
+                    succeeded = scenario(client, user)
+                except Exception:
+                    succeeded = False
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    if not succeeded:
+                        errors.append(1)
+
+        barrier = threading.Barrier(args.concurrency + 1)
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        queries_before = metrics.queries.value()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        if backend is not None:
+            serving.FILE_SERVING_BACKEND = backend
+        return summarize(latencies, len(errors), elapsed, metrics.queries.value() - queries_before)
+
+
+def compare(results, baseline, max_regression):
+    """List scenarios slower than the baseline by more than allowed"""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        p99, previous_p99 = current['latency_ms']['p99'], previous['latency_ms']['p99']
+        if previous_p99 and p99 > previous_p99 * (1 + max_regression):
+            regressions.append(f'{name}: p99 {previous_p99:.2f} ms -> {p99:.2f} ms')
+        if previous['throughput'] and current['throughput'] < previous['throughput'] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {previous['throughput']:.1f} -> "
+                               f"{current['throughput']:.1f} req/s")
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{name}: errors {previous['errors']} -> {current['errors']}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scratch = tempfile.mkdtemp(prefix='cloude-benchmark-')
+    os.environ['DATABASE_PATH'] = os.path.join(scratch, 'database.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(scratch, 'uploads')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    benchmark = None
+    try:
+        # Config is read at import, after the scratch paths are set
+        import app as app_module
+
+        benchmark = Benchmark(app_module, args)
+        print(f'Seeding {args.users} users with {args.files_per_user} files each in {scratch}')
+        seed_started = time.perf_counter()
+        benchmark.seed()
+        seed_seconds = time.perf_counter() - seed_started
+        if args.server:
+            benchmark.serve()
+
+        results = {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {key: value for key, value in vars(args).items()
+                         if key not in ('output', 'baseline', 'max_regression', 'keep')},
+            'seed_seconds': round(seed_seconds, 3),
+            'scenarios': {},
+        }
+        print(f"{'scenario':<16} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}")
+        for name in args.scenarios:
+            result = benchmark.run_scenario(name)
+            results['scenarios'][name] = result
+            print(f"{name:<16} {result['throughput']:>9.1f} {result['latency_ms']['p50']:>9.2f} "
+                  f"{result['latency_ms']['p99']:>9.2f} {result['queries_per_request']:>8.1f} "
+                  f"{result['errors']:>7}")
+    finally:
+        if benchmark is not None and benchmark.server is not None:
+            benchmark.server.shutdown()
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings') != results['settings']:
+            print('Note: the baseline was run with different settings')
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print('Regressions against the baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+        print('No regressions against the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import gzip
+import hashlib
+import os
+import shutil
+import uuid
+
+from config import (UPLOAD_FOLDER, BLOB_FOLDER, UPLOAD_TMP_FOLDER, UPLOAD_STREAM_BLOCK_SIZE, STORAGE_CODEC,
+                    STORAGE_COMPRESSED_MIME_TYPES, STORAGE_COMPRESSION_LEVEL, STORAGE_COMPRESSION_MIN_SIZE,
+                    STORAGE_COMPRESSION_MAX_RATIO)
+from storage import storage
+
+# Blob keys start with where blobs are below UPLOAD_FOLDER, so the local
+# backend keeps its layout
+BLOB_PREFIX = os.path.relpath(BLOB_FOLDER, UPLOAD_FOLDER).replace(os.sep, '/')
+
+
+def blob_key(content_hash):
+    """Get the storage key of the blob with a SHA-256 hash"""
+    return f'{BLOB_PREFIX}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}'
+
+
+class HashingTempFile:
+    """Writable temporary file that hashes whatever is written to it
+
+    Used as the target of multipart parsing, so uploaded files go straight
+    to disk and are hashed on the way without a second pass.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(UPLOAD_TMP_FOLDER, uuid.uuid4().hex)
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, 'w+b')
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def finish(self):
+        """Close the file, returns its path, SHA-256 hex digest and size"""
+        self.close()
+        return self.path, self._digest.hexdigest(), self.size
+
+    def discard(self):
+        """Close and remove the file unless it was moved into the store"""
+        self.close()
+        discard(self.path)
+
+
+def hash_file(path):
+    """Get the SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(UPLOAD_STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _GzipReader(gzip.GzipFile):
+    """Decompressing reader that closes the stream it reads from"""
+
+    def __init__(self, raw):
+        super().__init__(fileobj=raw, mode='rb')
+        self._raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+def _decoded(raw, encoding):
+    return _GzipReader(raw) if encoding == 'gzip' else raw
+
+
+def open_blob(key, encoding=None):
+    """Open a stored file for reading its original bytes
+
+    Raises FileNotFoundError if it isn't in storage.
+    """
+    return _decoded(storage.open(key), encoding)
+
+
+def _write_encoded(source, path, encoding):
+    """Copy a readable file to path, compressed with the given codec"""
+    with open(path, 'wb') as raw:
+        if encoding == 'gzip':
+            # No name or mtime in the header, equal content gives equal bytes
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=STORAGE_COMPRESSION_LEVEL,
+                               mtime=0) as target:
+                shutil.copyfileobj(source, target, UPLOAD_STREAM_BLOCK_SIZE)
+        else:
+            shutil.copyfileobj(source, raw, UPLOAD_STREAM_BLOCK_SIZE)
+
+
+def is_compressible(mime_type, size):
+    """Check whether an upload should be tried with the storage codec"""
+    return (STORAGE_CODEC is not None and size >= STORAGE_COMPRESSION_MIN_SIZE
+            and mime_type.startswith(STORAGE_COMPRESSED_MIME_TYPES))
+
+
+def encode_upload(temp_path, mime_type, size):
+    """Compress an uploaded temporary file if its type benefits from it
+
+    Returns the path, encoding and size of what should be stored. Files
+    that don't shrink enough are kept as they are, encoding None.
+    """
+    if not is_compressible(mime_type, size):
+        return temp_path, None, size
+
+    encoded_path = f'{temp_path}.{STORAGE_CODEC}'
+    with open(temp_path, 'rb') as source:
+        _write_encoded(source, encoded_path, STORAGE_CODEC)
+
+    stored_size = os.path.getsize(encoded_path)
+    if stored_size > size * STORAGE_COMPRESSION_MAX_RATIO:
+        discard(encoded_path)
+        return temp_path, None, size
+
+    discard(temp_path)
+    return encoded_path, STORAGE_CODEC, stored_size
+
+
+def commit_blob(temp_path, content_hash, encoding=None, blob_encoding=None):
+    """Move a temporary file into the store, or drop it if the blob exists
+
+    `encoding` is how the temporary file is encoded and `blob_encoding` how
+    the blob is recorded. They differ only when the same content arrived
+    concurrently as another type, the file is then re-encoded to match.
+    """
+    key = blob_key(content_hash)
+
+    if storage.exists(key):
+        discard(temp_path)
+        return key
+
+    if encoding != blob_encoding:
+        recoded_path = f'{temp_path}.recoded'
+        with _decoded(open(temp_path, 'rb'), encoding) as source:
+            _write_encoded(source, recoded_path, blob_encoding)
+        discard(temp_path)
+        temp_path = recoded_path
+
+    storage.put(key, temp_path)
+    return key
+
+
+def remove(key):
+    """Remove a stored file"""
+    storage.delete(key)
+
+
+def discard(path):
+    """Remove a local file if it is still there"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
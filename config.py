@@ -7,12 +7,26 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Secret key for sessions
 SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
 
-# Database path
-DATABASE_PATH = os.path.join(BASE_DIR, 'instance', 'database.db')
+# Database path, overridable to run against a scratch copy
+DATABASE_PATH = os.environ.get('DATABASE_PATH') or os.path.join(BASE_DIR, 'instance', 'database.db')
+
+# Database connection settings
+DB_POOL_SIZE = 16  # idle connections kept open between requests
+DB_BUSY_TIMEOUT = 10  # seconds to wait for the write lock
+DB_CACHE_SIZE_KB = 16 * 1024  # page cache per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024  # memory-mapped I/O window
+DB_STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+
+# In-process cache of user and file rows
+ROW_CACHE_SIZE = 10000  # rows per cache
+ROW_CACHE_TTL = 30  # seconds, bounds staleness across worker processes
+
+# Public download counters are written in batches
+DOWNLOAD_COUNT_FLUSH_INTERVAL = 5  # seconds
 
 # Upload settings
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB max file size
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(BASE_DIR, 'uploads')
+MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # 100MB max request, larger files upload in chunks
 ALLOWED_EXTENSIONS = {
     'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx',
     'xls', 'xlsx', 'ppt', 'pptx', 'zip', 'rar', 'mp3', 'mp4',
@@ -20,6 +34,133 @@ ALLOWED_EXTENSIONS = {
 }
 DANGEROUS_EXTENSIONS = {'exe', 'bat', 'cmd', 'sh', 'ps1', 'vbs', 'js', 'jar'}
 
+# Chunked uploads
+UPLOAD_TMP_FOLDER = os.path.join(UPLOAD_FOLDER, '.incoming')  # same disk as uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB per chunk request
+UPLOAD_MAX_FILE_SIZE = 50 * 1024 * 1024 * 1024  # 50GB per chunked file
+UPLOAD_STREAM_BLOCK_SIZE = 64 * 1024  # bytes copied to disk at a time
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds without a chunk before an unfinished upload is dropped
+UPLOAD_BATCH_MAX_FILES = 500  # files per /upload/batch request
+
+# Delta uploads: a client fetches block checksums of a stored file and
+# sends only the blocks that changed, the server rebuilds the new version
+DELTA_BLOCK_SIZE = 64 * 1024  # smallest block size
+DELTA_MAX_BLOCKS = 16384  # block size doubles until a file fits in this many
+
+# Where stored files live:
+#   'local' - below UPLOAD_FOLDER
+#   's3'    - an S3-compatible bucket (AWS, MinIO, ...), needs boto3.
+#             Credentials come from the AWS_* environment variables.
+# Temporary files and thumbnails stay in UPLOAD_FOLDER either way. When
+# switching, copy everything in UPLOAD_FOLDER except .incoming and .thumbs
+# to the bucket under the same keys.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')  # prepended to every key, e.g. 'cloude/'
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # for MinIO and other S3-compatible stores
+S3_REGION = os.environ.get('S3_REGION')
+S3_MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024  # larger files upload in parts of this size
+S3_MULTIPART_CONCURRENCY = 8  # parts uploaded in parallel
+
+# Content-addressed blob store, files with identical bytes share one blob
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, '.blobs')
+# Let clients skip sending the body when a blob with their SHA-256 exists.
+# There is no proof the client has the content: anyone who learns a hash
+# and size gets their own copy of that file, whatever its owner unshares
+# since. Only enable it where every user may read every file.
+BLOB_CLIENT_HASH_DEDUP = False
+
+# Transparent compression of stored files. Compressible uploads are kept
+# compressed and sent as Content-Encoding to clients that accept it, others
+# get them decompressed on the fly. Quotas count the original size.
+STORAGE_CODEC = 'gzip'  # None stores everything as uploaded
+STORAGE_COMPRESSED_MIME_TYPES = ('text/', 'application/json', 'application/xml')  # prefixes
+STORAGE_COMPRESSION_LEVEL = 6
+STORAGE_COMPRESSION_MIN_SIZE = 1024  # bytes, smaller files aren't worth it
+STORAGE_COMPRESSION_MAX_RATIO = 0.9  # stored raw unless compressed to at most this fraction
+
+# Thumbnails, rendered in the background in every size and format
+THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, '.thumbs')
+THUMBNAIL_SIZES = (150, 300, 600)  # bounding boxes in pixels, ascending
+THUMBNAIL_FORMATS = ('webp', 'jpeg')  # webp for browsers that accept it
+THUMBNAIL_WORKERS = 2  # rendering processes
+THUMBNAIL_PENDING_TIMEOUT = 10 * 60  # seconds before a lost job is retried
+THUMBNAIL_FAILED_RETRY = 60 * 60  # seconds before a failed job is retried
+
+# Deleted files are removed from disk in the background
+REAPER_INTERVAL = 5  # seconds between reaper runs
+REAPER_BATCH_SIZE = 200  # deletions per transaction
+# The orphan collector walks UPLOAD_FOLDER a batch per reaper run, which
+# bounds its disk I/O, and remembers where it stopped across restarts
+GC_INTERVAL = 6 * 60 * 60  # seconds between passes
+GC_BATCH_SIZE = 500  # entries checked per reaper run
+GC_GRACE_PERIOD = 60 * 60  # seconds before an unreferenced file counts as orphaned
+
+# File serving
+FILE_CACHE_MAX_AGE = 365 * 24 * 60 * 60  # stored files never change
+MAX_BYTE_RANGES = 16  # larger multi-range requests get the whole file
+# Who sends file bytes once a route has checked access:
+#   'send_file'        - the worker, through wsgi.file_wrapper (sendfile where
+#                        the server supports it)
+#   'x-accel-redirect' - nginx, from an internal location aliased to
+#                        UPLOAD_FOLDER, e.g.
+#                          location /protected-uploads/ { internal; alias /path/to/uploads/; }
+#   'x-sendfile'       - Apache mod_xsendfile or lighttpd, by absolute path
+FILE_SERVING_BACKEND = os.environ.get('FILE_SERVING_BACKEND', 'send_file')
+FILE_ACCEL_REDIRECT_PREFIX = '/protected-uploads/'
+
+# Folder and multi-file ZIP downloads
+ARCHIVE_STORED_TYPES = {  # already compressed, stored as-is
+    'png', 'jpg', 'jpeg', 'gif', 'webp', 'zip', 'rar', '7z', 'gz',
+    'mp3', 'mp4', 'avi', 'mov', 'wmv', 'flv', 'webm',
+    'docx', 'xlsx', 'pptx'
+}
+ARCHIVE_MAX_FILES = 10000  # files per archive
+
+# File list pagination
+FILES_PAGE_SIZE = 50
+FILES_PAGE_SIZE_MAX = 200
+
+# Change journal behind /api/changes, for sync clients. Entries older than
+# the retention are pruned by the reaper, cursors from before then expire
+# and their clients have to list everything again.
+CHANGES_PAGE_SIZE = 1000
+CHANGES_PAGE_SIZE_MAX = 5000
+CHANGES_RETENTION = 30 * 24 * 60 * 60  # seconds
+
+# Public share pages. Rendered pages are kept in memory per link and sent
+# with cache headers, so a popular link is served without the database.
+SHARE_PAGE_CACHE_SIZE = 10000  # rendered pages
+SHARE_PAGE_CACHE_TTL = 60  # seconds, bounds how stale the download count gets
+SHARE_PAGE_MAX_AGE = 60  # seconds browsers and proxies may reuse a page
+# Shown inline on share pages and in the browser, anything else is always
+# downloaded (SVG and HTML could run scripts on this origin)
+SHARE_INLINE_MIME_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/')
+
+# Metrics at /metrics, in the Prometheus text format. Each worker process
+# keeps its own, so scrape workers individually or run a single one.
+# Without a token only direct requests from localhost are answered. A
+# reverse proxy on the same host connects from localhost too: requests it
+# forwards are refused as long as it sets X-Forwarded-For, X-Real-IP or
+# Forwarded. Otherwise set METRICS_TOKEN or block /metrics in the proxy.
+METRICS_ENABLED = True
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # bearer token, required when set
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+# Logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # 'text' (key=value) or 'json'
+LOG_DEBUG_SAMPLE_RATE = 1.0  # fraction of DEBUG and INFO records kept
+
+# Production server, `python asgi.py`. Views run on a bounded thread pool
+# while request and response bodies move on the event loop, so slow
+# transfers don't hold threads.
+SERVER_HOST = os.environ.get('HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('PORT', 8000))
+SERVER_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))  # processes, each with its own metrics
+ASGI_THREADS = 32  # threads running views and reading response blocks
+ASGI_SPOOL_MAX_MEMORY = 1024 * 1024  # larger request bodies are spooled to UPLOAD_TMP_FOLDER
+
 # Session settings
 PERMANENT_SESSION_LIFETIME = timedelta(days=7)
 SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
@@ -33,4 +174,7 @@ STORAGE_LIMITS = {
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(os.path.join(BASE_DIR, 'instance'), exist_ok=True)
+os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+os.makedirs(BLOB_FOLDER, exist_ok=True)
+os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
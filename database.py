@@ -1,15 +1,218 @@
 import sqlite3
 import os
-from datetime import datetime
+import atexit
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
 from werkzeug.security import generate_password_hash, check_password_hash
-from config import DATABASE_PATH, BASE_DIR
+from werkzeug.utils import secure_filename
+from config import (DATABASE_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT,
+                    DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_STATEMENT_CACHE_SIZE,
+                    ROW_CACHE_SIZE, ROW_CACHE_TTL, DOWNLOAD_COUNT_FLUSH_INTERVAL, UPLOAD_FOLDER,
+                    METRICS_ENABLED)
+import metrics
+from logs import get_logger
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE_PATH)
+logger = get_logger('database')
+
+# Ids bound per IN (...) query, well under SQLite's variable limit
+IDS_PER_QUERY = 500
+
+# Idle connections shared between worker threads
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+# Connection currently checked out by this thread
+_local = threading.local()
+
+# Every RowCache created, reported by cache_stats
+_row_caches = []
+
+
+class RowCache:
+    """Thread-safe LRU cache of rows that expire after a TTL"""
+
+    def __init__(self, name, maxsize, ttl):
+        _row_caches.append(self)
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached row, or None"""
+        with self._lock:
+            entry = self._rows.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._rows[key]
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, row):
+        """Cache a row, evicting the least recently used one if full"""
+        if row is None:
+            return
+        with self._lock:
+            self._rows[key] = (time.monotonic() + self.ttl, row)
+            self._rows.move_to_end(key)
+            if len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop a row from the cache"""
+        with self._lock:
+            self._rows.pop(key, None)
+
+    def clear(self):
+        """Drop every row"""
+        with self._lock:
+            self._rows.clear()
+
+    def stats(self):
+        """Get size and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._rows),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+# Rows read on nearly every request. Writers below invalidate them, the TTL
+# bounds staleness from other processes and from download counters.
+user_cache = RowCache('users', ROW_CACHE_SIZE, ROW_CACHE_TTL)
+file_cache = RowCache('files', ROW_CACHE_SIZE, ROW_CACHE_TTL)
+share_link_cache = RowCache('share_links', ROW_CACHE_SIZE, ROW_CACHE_TTL)
+
+
+def cache_stats():
+    """Get hit/miss counters of every row cache"""
+    return {cache.name: cache.stats() for cache in _row_caches}
+
+
+def _invalidate_file(file):
+    """Drop a file row from the cache, its share links then stop resolving"""
+    file_cache.invalidate(file['id'])
+
+
+# Recomputes users.used_bytes from the files table
+RECONCILE_STORAGE_SQL = '''
+    UPDATE users SET used_bytes = (
+        SELECT COALESCE(SUM(file_size), 0) FROM files WHERE files.user_id = users.id
+    )
+'''
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that reports statement counts and time to the metrics"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.record_query(time.perf_counter() - started, count=0)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.record_query(time.perf_counter() - started, count=0)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection whose cursors and commits are timed"""
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.record_query(time.perf_counter() - started, count=0)
+
+
+def _connect():
+    """Open a new tuned SQLite connection"""
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        factory=_TimedConnection if METRICS_ENABLED else sqlite3.Connection
+    )
     conn.row_factory = sqlite3.Row
+
+    # WAL lets readers run alongside a writer; NORMAL sync is durable in WAL mode
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{int(DB_CACHE_SIZE_KB)}')
+    conn.execute(f'PRAGMA mmap_size = {int(DB_MMAP_SIZE)}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def get_db():
+    """Get the database connection checked out by the current thread"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _connect()
+        _local.conn = conn
     return conn
 
+
+def release_db(exception=None):
+    """Return the current thread's connection to the pool"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+
+    # Never hand a connection with an open transaction to another request
+    if conn.in_transaction:
+        conn.rollback()
+
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def init_db():
     """Initialize database with required tables"""
     conn = get_db()
@@ -24,7 +227,8 @@ def init_db():
             password_hash TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             storage_limit INTEGER DEFAULT 5368709120, -- 5GB in bytes
-            plan TEXT DEFAULT 'free'
+            plan TEXT DEFAULT 'free',
+            used_bytes INTEGER NOT NULL DEFAULT 0
         )
     ''')
     
@@ -61,14 +265,428 @@ def init_db():
         )
     ''')
 
-    # Try to add folder column if table exists but column doesn't
-    try:
-        cursor.execute('ALTER TABLE files ADD COLUMN folder TEXT DEFAULT ""')
-    except sqlite3.OperationalError:
-        pass
-
     conn.commit()
-    conn.close()
+
+    # Bring older databases up to the current schema
+    migrate_db()
+
+
+def _column_exists(cursor, table, column):
+    """Check whether a table already has a column"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    return any(row['name'] == column for row in cursor.fetchall())
+
+
+def _migration_files_folder(cursor):
+    """Add the folder column to files"""
+    if not _column_exists(cursor, 'files', 'folder'):
+        cursor.execute("ALTER TABLE files ADD COLUMN folder TEXT DEFAULT ''")
+
+
+def _migration_users_used_bytes(cursor):
+    """Add the storage counter to users and fill it from files"""
+    if not _column_exists(cursor, 'users', 'used_bytes'):
+        cursor.execute('ALTER TABLE users ADD COLUMN used_bytes INTEGER NOT NULL DEFAULT 0')
+    cursor.execute(RECONCILE_STORAGE_SQL)
+
+
+def _migration_files_indexes(cursor):
+    """Index the files listings for (uploaded_at, id) keyset pagination"""
+    # Ascending indexes end in the rowid, so a backward scan yields
+    # ORDER BY uploaded_at DESC, id DESC without a temp sort.
+    # Folder listing: WHERE user_id = ? AND folder = ?
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_user_folder_keyset
+        ON files (user_id, folder, uploaded_at)
+    ''')
+    # Listing of all user files: WHERE user_id = ?
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_user_keyset
+        ON files (user_id, uploaded_at)
+    ''')
+
+
+def _migration_upload_sessions(cursor):
+    """Track chunked uploads in progress"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            original_filename TEXT NOT NULL,
+            folder TEXT DEFAULT '',
+            file_size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            temp_path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_user
+        ON upload_sessions (user_id)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index),
+            FOREIGN KEY (upload_id) REFERENCES upload_sessions (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_blobs(cursor):
+    """Reference-count content-addressed blobs shared between files"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+    # NULL for files stored before the blob store existed
+    if not _column_exists(cursor, 'files', 'content_hash'):
+        cursor.execute('ALTER TABLE files ADD COLUMN content_hash TEXT')
+
+
+def _migration_thumbnails(cursor):
+    """Index the thumbnail cache by source content"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            source_key TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending', -- pending, ready or failed
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+
+
+SEARCH_COLUMNS = ('original_filename', 'folder', 'file_type', 'mime_type')
+
+
+def _migration_files_search(cursor):
+    """Full-text index over file names, kept in sync by triggers
+
+    The index is contentless, results are joined back to files by id. The
+    owner column holds 'u<user_id>' so a search is narrowed to one user
+    inside the index rather than after it.
+    """
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_search USING fts5(
+            owner, original_filename, folder, file_type, mime_type,
+            content='', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+        )
+    ''')
+
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in SEARCH_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in SEARCH_COLUMNS)
+    index_new = f'''
+        INSERT INTO files_search (rowid, owner, {columns})
+        VALUES (new.id, 'u' || new.user_id, {new_values});
+    '''
+    # Contentless tables are told what to remove
+    unindex_old = f'''
+        INSERT INTO files_search (files_search, rowid, owner, {columns})
+        VALUES ('delete', old.id, 'u' || old.user_id, {old_values});
+    '''
+
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN {index_new} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN {unindex_old} END')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_search_update
+        AFTER UPDATE OF user_id, {columns} ON files
+        BEGIN {unindex_old} {index_new} END
+    ''')
+
+    cursor.execute(f'''
+        INSERT INTO files_search (rowid, owner, {columns})
+        SELECT id, 'u' || user_id, {columns} FROM files
+    ''')
+
+
+def _migration_folders(cursor):
+    """Keep the folder tree in a table instead of directories on disk
+
+    Each folder stores its materialised path ('photos/2024'), files keep
+    referring to their folder by that path. A subtree is then one range of
+    the (user_id, path) index: path = 'a' or 'a/' <= path < 'a0'.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS folders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            parent_id INTEGER,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (parent_id) REFERENCES folders (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_folders_user_path
+        ON folders (user_id, path)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_folders_user_parent
+        ON folders (user_id, parent_id, name)
+    ''')
+    # Folder sizes are summed from the index alone
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_user_folder_size
+        ON files (user_id, folder, file_size)
+    ''')
+
+    # Folders used by files, plus empty ones that only exist on disk
+    cursor.execute("SELECT DISTINCT user_id, folder FROM files WHERE folder != ''")
+    existing = {tuple(row) for row in cursor.fetchall()}
+    if os.path.isdir(UPLOAD_FOLDER):
+        for user_dir in os.listdir(UPLOAD_FOLDER):
+            user_path = os.path.join(UPLOAD_FOLDER, user_dir)
+            if not user_dir.isdigit() or not os.path.isdir(user_path):
+                continue
+            for root, dirs, _ in os.walk(user_path):
+                for name in dirs:
+                    relative = os.path.relpath(os.path.join(root, name), user_path)
+                    existing.add((int(user_dir), relative.replace(os.sep, '/')))
+
+    for user_id, path in sorted(existing):
+        _ensure_folder(cursor, user_id, path)
+
+
+def _migration_deferred_deletes(cursor):
+    """Queue storage for background removal and track the orphan collector"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_deletes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT, -- NULL for files stored outside the blob store
+            filepath TEXT NOT NULL,
+            thumbnail_key TEXT NOT NULL,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gc_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID
+    ''')
+    # Lets the collector look up files stored outside the blob store
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_legacy_filename
+        ON files (filename) WHERE content_hash IS NULL
+    ''')
+
+
+def _migration_blob_encoding(cursor):
+    """Record how blobs are encoded on disk and how much space they take
+
+    NULL means stored as uploaded, in size bytes. Files copy both from their
+    blob so serving them needs no join.
+    """
+    for table in ('blobs', 'files'):
+        if not _column_exists(cursor, table, 'encoding'):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN encoding TEXT')
+        if not _column_exists(cursor, table, 'stored_size'):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN stored_size INTEGER')
+
+
+def _migration_relative_storage_keys(cursor):
+    """Store files by a key relative to the storage backend's root
+
+    files.filepath held absolute paths, which tie rows to one machine's
+    disk. Paths outside UPLOAD_FOLDER are left as they are, the local
+    backend still finds them.
+    """
+    prefix = os.path.join(UPLOAD_FOLDER, '')
+    for table in ('files', 'pending_deletes'):
+        cursor.execute(
+            f'''UPDATE {table} SET filepath = replace(substr(filepath, ?), ?, '/')
+                WHERE substr(filepath, 1, ?) = ?''',
+            (len(prefix) + 1, os.sep, len(prefix), prefix)
+        )
+
+
+def _migration_change_journal(cursor):
+    """Journal of changes to files and folders, written by triggers
+
+    Ids only grow, so a sync client keeps the last id it has seen as its
+    cursor and asks for what came after. Every write path is covered,
+    including batches, folder deletes and moves, without touching them.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            item_type TEXT NOT NULL, -- 'file' or 'folder'
+            item_id INTEGER NOT NULL,
+            action TEXT NOT NULL, -- 'created', 'updated', 'shared', 'unshared' or 'deleted'
+            path TEXT NOT NULL, -- the file's folder or the folder's path
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_changes_user
+        ON changes (user_id, id)
+    ''')
+
+    def journal(row, item_type, action, path):
+        return f'''
+            INSERT INTO changes (user_id, item_type, item_id, action, path)
+            VALUES ({row}.user_id, '{item_type}', {row}.id, {action}, {row}.{path});
+        '''
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_changes_insert AFTER INSERT ON files
+        BEGIN {journal('new', 'file', "'created'", 'folder')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_changes_delete AFTER DELETE ON files
+        BEGIN {journal('old', 'file', "'deleted'", 'folder')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_changes_update
+        AFTER UPDATE OF original_filename, folder ON files
+        WHEN new.original_filename IS NOT old.original_filename OR new.folder IS NOT old.folder
+        BEGIN {journal('new', 'file', "'updated'", 'folder')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS files_changes_share
+        AFTER UPDATE OF is_public, public_token ON files
+        WHEN new.is_public IS NOT old.is_public OR new.public_token IS NOT old.public_token
+        BEGIN {journal('new', 'file', "CASE WHEN new.is_public THEN 'shared' ELSE 'unshared' END", 'folder')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS folders_changes_insert AFTER INSERT ON folders
+        BEGIN {journal('new', 'folder', "'created'", 'path')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS folders_changes_delete AFTER DELETE ON folders
+        BEGIN {journal('old', 'folder', "'deleted'", 'path')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS folders_changes_update
+        AFTER UPDATE OF path ON folders WHEN new.path IS NOT old.path
+        BEGIN {journal('new', 'folder', "'updated'", 'path')} END
+    ''')
+
+
+def _migration_block_signatures(cursor):
+    """Cache block checksums of blobs for delta uploads, they never change"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS block_signatures (
+            content_hash TEXT NOT NULL,
+            block_size INTEGER NOT NULL,
+            signature BLOB NOT NULL,
+            PRIMARY KEY (content_hash, block_size)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_shared_links(cursor):
+    """Keep share links in shared_links, several per file and able to expire
+
+    files.is_public and files.public_token allowed one link per file; they
+    are moved over and no longer used. The UNIQUE constraint on token
+    already indexes lookups.
+    """
+    if not _column_exists(cursor, 'shared_links', 'download_count'):
+        cursor.execute('ALTER TABLE shared_links ADD COLUMN download_count INTEGER DEFAULT 0')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_shared_links_file
+        ON shared_links (file_id, id)
+    ''')
+    # Lets the sweeper find expired links without scanning the others
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_shared_links_expires
+        ON shared_links (expires_at) WHERE expires_at IS NOT NULL
+    ''')
+
+    cursor.execute('''
+        INSERT OR IGNORE INTO shared_links (file_id, token, download_count)
+        SELECT id, public_token, download_count FROM files
+        WHERE is_public = 1 AND public_token IS NOT NULL
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS files_changes_share')
+    cursor.execute('UPDATE files SET is_public = 0, public_token = NULL WHERE public_token IS NOT NULL')
+
+    # Journal creating and removing links as before
+    for event, row, action in (('INSERT', 'new', 'shared'), ('DELETE', 'old', 'unshared')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS shared_links_changes_{event.lower()} AFTER {event} ON shared_links
+            BEGIN
+                INSERT INTO changes (user_id, item_type, item_id, action, path)
+                SELECT user_id, 'file', id, '{action}', folder FROM files WHERE id = {row}.file_id;
+            END
+        ''')
+
+
+def _migration_upload_sessions_temp_path(cursor):
+    """Let the orphan collector look up upload temp files by path"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_temp_path
+        ON upload_sessions (temp_path)
+    ''')
+
+
+def _migration_upload_sessions_activity(cursor):
+    """Expire chunked uploads by their last chunk instead of their start
+
+    A slow but steady upload must outlive UPLOAD_SESSION_TTL. Added
+    columns can't default to CURRENT_TIMESTAMP, so new sessions set it.
+    """
+    if not _column_exists(cursor, 'upload_sessions', 'last_activity'):
+        cursor.execute('ALTER TABLE upload_sessions ADD COLUMN last_activity TIMESTAMP')
+    cursor.execute('UPDATE upload_sessions SET last_activity = created_at WHERE last_activity IS NULL')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_activity
+        ON upload_sessions (last_activity)
+    ''')
+
+
+# Schema migrations, applied in order. PRAGMA user_version stores how many
+# of them the database has already seen, so only append to this list.
+MIGRATIONS = [
+    _migration_files_folder,
+    _migration_users_used_bytes,
+    _migration_files_indexes,
+    _migration_upload_sessions,
+    _migration_blobs,
+    _migration_thumbnails,
+    _migration_files_search,
+    _migration_folders,
+    _migration_deferred_deletes,
+    _migration_blob_encoding,
+    _migration_relative_storage_keys,
+    _migration_change_journal,
+    _migration_block_signatures,
+    _migration_shared_links,
+    _migration_upload_sessions_temp_path,
+    _migration_upload_sessions_activity,
+]
+
+
+def migrate_db():
+    """Apply pending schema migrations"""
+    conn = get_db()
+    cursor = conn.cursor()
+
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Each migration and its version bump commit together
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {number}')
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    return len(MIGRATIONS)
+
 
 def create_user(username, email, password):
     """Create a new user"""
@@ -83,17 +701,11 @@ def create_user(username, email, password):
             (username, email, password_hash)
         )
         user_id = cursor.lastrowid
-        
-        # Create user's upload directory
-        user_upload_dir = os.path.join(BASE_DIR, 'uploads', str(user_id))
-        os.makedirs(user_upload_dir, exist_ok=True)
-        
         conn.commit()
         return user_id
     except sqlite3.IntegrityError:
+        conn.rollback()
         return None
-    finally:
-        conn.close()
 
 def get_user_by_username(username):
     """Get user by username"""
@@ -101,16 +713,19 @@ def get_user_by_username(username):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
     user = cursor.fetchone()
-    conn.close()
     return user
 
 def get_user_by_id(user_id):
     """Get user by ID"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
     user = cursor.fetchone()
-    conn.close()
+    user_cache.set(user_id, user)
     return user
 
 def verify_password(username, password):
@@ -122,134 +737,1116 @@ def verify_password(username, password):
 
 def get_file_by_id(file_id, user_id=None):
     """Get file by ID, optionally check ownership"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    if user_id:
-        cursor.execute(
-            'SELECT * FROM files WHERE id = ? AND user_id = ?',
-            (file_id, user_id)
-        )
-    else:
+    file = file_cache.get(file_id)
+    if file is None:
+        conn = get_db()
+        cursor = conn.cursor()
         cursor.execute('SELECT * FROM files WHERE id = ?', (file_id,))
-    
-    file = cursor.fetchone()
-    conn.close()
+        file = cursor.fetchone()
+        file_cache.set(file_id, file)
+
+    if file is not None and user_id and file['user_id'] != user_id:
+        return None
     return file
 
 def get_user_storage_usage(user_id):
     """Get total storage usage for a user"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        'SELECT COALESCE(SUM(file_size), 0) as total_size FROM files WHERE user_id = ?',
-        (user_id,)
-    )
+    cursor.execute('SELECT used_bytes FROM users WHERE id = ?', (user_id,))
     result = cursor.fetchone()
-    conn.close()
-    return result['total_size'] if result else 0
+    return result['used_bytes'] if result else 0
 
-def delete_file(file_id, user_id):
-    """Delete a file"""
+def reconcile_storage_usage(user_id=None):
+    """Rebuild storage counters from the files table"""
     conn = get_db()
     cursor = conn.cursor()
-    
-    # Get file info before deleting
-    file = get_file_by_id(file_id, user_id)
-    if not file:
-        return False
-    
-    # Delete from database
-    cursor.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (file_id, user_id))
-    
-    # Delete physical file
-    try:
-        os.remove(file['filepath'])
-    except OSError:
-        pass
-    
+
+    if user_id is not None:
+        cursor.execute(RECONCILE_STORAGE_SQL + ' WHERE id = ?', (user_id,))
+    else:
+        cursor.execute(RECONCILE_STORAGE_SQL)
+
     conn.commit()
-    conn.close()
-    return True
+    user_cache.clear()
+    return cursor.rowcount
 
-def create_share_token(file_id):
-    """Create a share token for a file"""
-    import uuid
-    token = str(uuid.uuid4())
-    
+def delete_file(file_id, user_id):
+    """Delete a file, its storage is removed later by the reaper"""
+    return delete_files(user_id, [file_id]) == 1
+
+
+def delete_files(user_id, file_ids):
+    """Delete many of a user's files in one transaction, returns how many"""
     conn = get_db()
     cursor = conn.cursor()
-    
-    # Update file to be public
-    cursor.execute(
-        'UPDATE files SET is_public = 1, public_token = ? WHERE id = ?',
-        (token, file_id)
-    )
-    
+
+    files = []
+    file_ids = list(file_ids)
+    for start in range(0, len(file_ids), IDS_PER_QUERY):
+        chunk = file_ids[start:start + IDS_PER_QUERY]
+        cursor.execute(
+            f'''SELECT id, filepath, file_size, content_hash FROM files
+                WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})''',
+            (user_id, *chunk)
+        )
+        files.extend(cursor.fetchall())
+
+    _delete_file_rows(cursor, user_id, files)
     conn.commit()
-    conn.close()
-    return token
 
-def disable_share_token(file_id, user_id):
-    """Disable sharing for a file"""
+    _invalidate_deleted(user_id, files)
+    return len(files)
+
+
+def delete_user_folder(user_id, path):
+    """Delete a folder with its subfolders and files, returns the file count
+
+    Returns None if the folder doesn't exist.
+    """
     conn = get_db()
     cursor = conn.cursor()
-    
+
+    if not path or not get_folder(user_id, path):
+        return None
+
+    low, high = _subtree_range(path)
     cursor.execute(
-        'UPDATE files SET is_public = 0, public_token = NULL WHERE id = ? AND user_id = ?',
-        (file_id, user_id)
+        '''SELECT id, filepath, file_size, content_hash FROM files
+           WHERE user_id = ? AND (folder = ? OR (folder >= ? AND folder < ?))''',
+        (user_id, path, low, high)
     )
-    
-    conn.commit()
-    conn.close()
+    files = cursor.fetchall()
 
-def get_public_file(token):
-    """Get public file by token"""
-    conn = get_db()
-    cursor = conn.cursor()
+    _delete_file_rows(cursor, user_id, files)
     cursor.execute(
-        'SELECT * FROM files WHERE public_token = ? AND is_public = 1',
-        (token,)
+        '''DELETE FROM folders WHERE user_id = ? AND (path = ? OR (path >= ? AND path < ?))''',
+        (user_id, path, low, high)
     )
-    file = cursor.fetchone()
-    conn.close()
-    return file
+    conn.commit()
 
+    _invalidate_deleted(user_id, files)
+    return len(files)
 
-def add_file(user_id, filename, original_filename, filepath, file_size, file_type, mime_type, folder=''):
-    """Add file record to database"""
-    conn = get_db()
-    cursor = conn.cursor()
 
-    cursor.execute('''
-        INSERT INTO files (user_id, filename, original_filename, filepath, 
-                          file_size, file_type, mime_type, folder)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, filename, original_filename, filepath, file_size, file_type, mime_type, folder))
+def _delete_file_rows(cursor, user_id, files):
+    """Remove file rows, release their quota and queue their storage
 
-    file_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return file_id
+    Nothing is touched on disk. Blobs are queued only once their last
+    reference is gone, the reaper checks again before removing them.
+    """
+    if not files:
+        return
 
+    cursor.executemany('DELETE FROM files WHERE id = ?', [(file['id'],) for file in files])
+    cursor.executemany('DELETE FROM shared_links WHERE file_id = ?', [(file['id'],) for file in files])
+    cursor.execute(
+        'UPDATE users SET used_bytes = MAX(used_bytes - ?, 0) WHERE id = ?',
+        (sum(file['file_size'] for file in files), user_id)
+    )
+    cursor.executemany(
+        'UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = ?',
+        [(file['content_hash'],) for file in files if file['content_hash']]
+    )
+    cursor.executemany(
+        '''INSERT INTO pending_deletes (content_hash, filepath, thumbnail_key)
+           SELECT ?, ?, ? WHERE ? IS NULL
+               OR EXISTS (SELECT 1 FROM blobs WHERE sha256 = ? AND ref_count <= 0)''',
+        [(file['content_hash'], file['filepath'], file['content_hash'] or f"file-{file['id']}",
+          file['content_hash'], file['content_hash']) for file in files]
+    )
 
-def get_user_files(user_id, folder=''):
-    """Get files for a user, optionally filtered by folder"""
-    conn = get_db()
-    cursor = conn.cursor()
 
-    if folder:
+def _invalidate_deleted(user_id, files):
+    """Drop deleted files and their owner from the caches"""
+    for file in files:
+        _invalidate_file(file)
+    user_cache.invalidate(user_id)
+
+
+def reap_deleted_files(limit, remove):
+    """Remove the storage of up to `limit` queued deletions, returns how many
+
+    `remove(paths, thumbnail_keys)` deletes the bytes. It runs while the
+    write lock is held, so an upload can't re-reference a blob or its
+    thumbnails between the check and the removal.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute(
+            'SELECT id, content_hash, filepath, thumbnail_key FROM pending_deletes ORDER BY id LIMIT ?',
+            (limit,)
+        )
+        queued = cursor.fetchall()
+
+        paths = []
+        thumbnail_keys = []
+        content_hashes = []
+        for entry in queued:
+            if entry['content_hash']:
+                # Re-uploaded content keeps its blob
+                cursor.execute(
+                    'DELETE FROM blobs WHERE sha256 = ? AND ref_count <= 0',
+                    (entry['content_hash'],)
+                )
+                if cursor.rowcount == 0:
+                    continue
+                content_hashes.append(entry['content_hash'])
+            paths.append(entry['filepath'])
+            thumbnail_keys.append(entry['thumbnail_key'])
+
+        cursor.executemany(
+            'DELETE FROM thumbnails WHERE source_key = ?',
+            [(key,) for key in thumbnail_keys]
+        )
+        cursor.executemany(
+            'DELETE FROM block_signatures WHERE content_hash = ?',
+            [(content_hash,) for content_hash in content_hashes]
+        )
+        cursor.executemany(
+            'DELETE FROM pending_deletes WHERE id = ?',
+            [(entry['id'],) for entry in queued]
+        )
+
+        remove(paths, thumbnail_keys)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return len(queued)
+
+
+# How the collector tells whether something on disk is still referenced
+ORPHAN_CHECKS = {
+    'blob': 'SELECT 1 FROM blobs WHERE sha256 = ?',
+    'thumbnail': 'SELECT 1 FROM thumbnails WHERE source_key = ?',
+    'incoming': 'SELECT 1 FROM upload_sessions WHERE temp_path = ?',
+    'file': 'SELECT 1 FROM files WHERE filename = ? AND content_hash IS NULL',
+}
+
+
+def remove_orphans(entries, remove):
+    """Remove entries on disk that nothing refers to, returns their paths
+
+    `entries` holds (kind, key, path) tuples, kind being one of
+    ORPHAN_CHECKS. Checks and removals happen under the write lock, so a
+    concurrent upload can't start referencing something being removed.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    removed = []
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for kind, key, path in entries:
+            cursor.execute(ORPHAN_CHECKS[kind], (key,))
+            if cursor.fetchone() is None:
+                remove(path)
+                removed.append(path)
+    finally:
+        conn.rollback()
+
+    return removed
+
+
+def get_blob_hashes(after='', limit=500):
+    """Get blob hashes in order, starting after a given one"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT sha256 FROM blobs WHERE sha256 > ? ORDER BY sha256 LIMIT ?',
+        (after, limit)
+    )
+    return [row['sha256'] for row in cursor.fetchall()]
+
+
+def get_gc_state(key, default=''):
+    """Get a saved value of the orphan collector"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT value FROM gc_state WHERE key = ?', (key,))
+    row = cursor.fetchone()
+    return row['value'] if row else default
+
+
+def set_gc_state(**values):
+    """Save values of the orphan collector, so a pass survives restarts"""
+    conn = get_db()
+    conn.executemany(
+        'INSERT INTO gc_state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+        [(key, str(value)) for key, value in values.items()]
+    )
+    conn.commit()
+
+
+def _utc_timestamp(seconds_from_now=0):
+    """Format a UTC time like CURRENT_TIMESTAMP, so the two compare as text"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + seconds_from_now))
+
+
+# Token of a file's newest live link, for file listings
+ACTIVE_SHARE_TOKEN_SQL = '''
+    (SELECT token FROM shared_links
+     WHERE file_id = files.id AND is_active = 1
+         AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+     ORDER BY id DESC LIMIT 1)
+'''
+
+
+def create_share_token(file_id, user_id, expires_in=None):
+    """Create a share link to a user's file, returns its token
+
+    Returns None if the user has no such file. Links live until disabled,
+    or for `expires_in` seconds.
+    """
+    import uuid
+    token = str(uuid.uuid4())
+
+    if not get_file_by_id(file_id, user_id):
+        return None
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO shared_links (file_id, token, expires_at) VALUES (?, ?, ?)',
+        (file_id, token, _utc_timestamp(expires_in) if expires_in else None)
+    )
+    conn.commit()
+    return token
+
+
+def disable_share_token(file_id, user_id, token=None):
+    """Remove one share link of a user's file, or all of them, returns their tokens"""
+    if not get_file_by_id(file_id, user_id):
+        return []
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if token:
+        cursor.execute('SELECT token FROM shared_links WHERE file_id = ? AND token = ?', (file_id, token))
+    else:
+        cursor.execute('SELECT token FROM shared_links WHERE file_id = ?', (file_id,))
+    tokens = [row['token'] for row in cursor.fetchall()]
+
+    cursor.executemany('DELETE FROM shared_links WHERE token = ?', [(token,) for token in tokens])
+    conn.commit()
+
+    for token in tokens:
+        share_link_cache.invalidate(token)
+    return tokens
+
+
+def get_share_links(file_id, user_id):
+    """Get the live share links of a user's file, newest first"""
+    if not get_file_by_id(file_id, user_id):
+        return []
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''SELECT id, token, created_at, expires_at, download_count FROM shared_links
+           WHERE file_id = ? AND is_active = 1
+               AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+           ORDER BY id DESC''',
+        (file_id,)
+    )
+    return cursor.fetchall()
+
+
+def get_share_link(token):
+    """Get a live share link by its token
+
+    Cached like the file rows it points to, expiry is checked on every
+    lookup so a cached link stops resolving on time.
+    """
+    link = share_link_cache.get(token)
+    if link is None:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute(
+            '''SELECT id, file_id, token, created_at, expires_at, download_count FROM shared_links
+               WHERE token = ? AND is_active = 1''',
+            (token,)
+        )
+        link = cursor.fetchone()
+        share_link_cache.set(token, link)
+
+    if link is None or (link['expires_at'] is not None and link['expires_at'] <= _utc_timestamp()):
+        return None
+    return link
+
+
+def delete_expired_share_links(limit):
+    """Remove up to `limit` expired share links, returns how many"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''DELETE FROM shared_links WHERE id IN (
+               SELECT id FROM shared_links WHERE expires_at <= ? LIMIT ?
+           )''',
+        (_utc_timestamp(), limit)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def get_block_signature(content_hash, block_size):
+    """Get the cached block checksums of a blob, None if there are none"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT signature FROM block_signatures WHERE content_hash = ? AND block_size = ?',
+        (content_hash, block_size)
+    )
+    row = cursor.fetchone()
+    return row['signature'] if row else None
+
+
+def save_block_signature(content_hash, block_size, signature):
+    """Cache the block checksums of a blob"""
+    conn = get_db()
+    conn.execute(
+        'INSERT OR REPLACE INTO block_signatures (content_hash, block_size, signature) VALUES (?, ?, ?)',
+        (content_hash, block_size, signature)
+    )
+    conn.commit()
+
+
+# Adds a reference to a blob, recording its encoding if it's new
+BLOB_INSERT_SQL = '''
+    INSERT INTO blobs (sha256, size, ref_count, encoding, stored_size) VALUES (?, ?, 1, ?, ?)
+    ON CONFLICT (sha256) DO UPDATE SET ref_count = ref_count + 1
+'''
+
+# Files of a blob are encoded like it, whatever the upload was
+FILE_INSERT_SQL = '''
+    INSERT INTO files (user_id, filename, original_filename, filepath,
+                      file_size, file_type, mime_type, folder, content_hash, encoding, stored_size)
+    SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9,
+           CASE WHEN blobs.sha256 IS NULL THEN ?10 ELSE blobs.encoding END,
+           CASE WHEN blobs.sha256 IS NULL THEN ?11 ELSE blobs.stored_size END
+    FROM (SELECT 1) LEFT JOIN blobs ON blobs.sha256 = ?9
+'''
+
+
+def add_file(user_id, filename, original_filename, filepath, file_size, file_type, mime_type, folder='',
+             content_hash=None, blob_must_exist=False, encoding=None, stored_size=None):
+    """Add file record to database, returns None if it would exceed the quota
+
+    With a content_hash the file references a shared blob. blob_must_exist
+    only adds the file if that blob is already stored, also returning None
+    otherwise. `encoding` and `stored_size` describe a new blob, files of an
+    existing one take the blob's.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    # Reserve the space first: the conditional update takes the write lock,
+    # so concurrent uploads cannot both pass the quota check
+    cursor.execute(
+        '''UPDATE users SET used_bytes = used_bytes + ?
+           WHERE id = ? AND used_bytes + ? <= storage_limit''',
+        (file_size, user_id, file_size)
+    )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        return None
+
+    if content_hash and blob_must_exist:
+        cursor.execute(
+            'UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = ? AND ref_count > 0',
+            (content_hash,)
+        )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return None
+    elif content_hash:
+        cursor.execute(BLOB_INSERT_SQL, (content_hash, file_size, encoding, stored_size))
+
+    cursor.execute(FILE_INSERT_SQL, (user_id, filename, original_filename, filepath, file_size, file_type,
+                                     mime_type, folder, content_hash, encoding, stored_size))
+
+    file_id = cursor.lastrowid
+    conn.commit()
+
+    # The cached user row holds the old used_bytes
+    user_cache.invalidate(user_id)
+    return file_id
+
+
+def add_files(user_id, files):
+    """Add many file records in one transaction, returns their ids
+
+    `files` holds dicts with the add_file arguments. The whole batch is
+    checked against the quota once and None is returned if it doesn't fit.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    total_size = sum(file['file_size'] for file in files)
+    cursor.execute(
+        '''UPDATE users SET used_bytes = used_bytes + ?
+           WHERE id = ? AND used_bytes + ? <= storage_limit''',
+        (total_size, user_id, total_size)
+    )
+    if cursor.rowcount == 0:
+        conn.rollback()
+        return None
+
+    cursor.executemany(BLOB_INSERT_SQL, [
+        (file['content_hash'], file['file_size'], file.get('encoding'), file.get('stored_size'))
+        for file in files
+    ])
+
+    cursor.executemany(FILE_INSERT_SQL, [
+        (user_id, file['filename'], file['original_filename'], file['filepath'], file['file_size'],
+         file['file_type'], file['mime_type'], file['folder'], file['content_hash'],
+         file.get('encoding'), file.get('stored_size'))
+        for file in files
+    ])
+
+    # Rows inserted under one write lock get consecutive AUTOINCREMENT ids
+    last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+    conn.commit()
+
+    user_cache.invalidate(user_id)
+    return list(range(last_id - len(files) + 1, last_id + 1))
+
+
+def get_blob(content_hash):
+    """Get a stored blob that is still referenced"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT * FROM blobs WHERE sha256 = ? AND ref_count > 0',
+        (content_hash,)
+    )
+    return cursor.fetchone()
+
+
+class DownloadCounter:
+    """Aggregates download counts in memory and writes them in batches
+
+    A background thread flushes every DOWNLOAD_COUNT_FLUSH_INTERVAL seconds,
+    so a busy shared link costs one UPDATE per interval instead of one
+    write transaction per download.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def increment(self, file_id, link_id=None):
+        """Count one download, through a share link if link_id is given"""
+        key = (file_id, link_id)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='download-counter', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Write pending counts to the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        file_counts = {}
+        for (file_id, _), count in pending.items():
+            file_counts[file_id] = file_counts.get(file_id, 0) + count
+
+        try:
+            conn = get_db()
+            conn.executemany(
+                'UPDATE files SET download_count = download_count + ? WHERE id = ?',
+                [(count, file_id) for file_id, count in file_counts.items()]
+            )
+            conn.executemany(
+                'UPDATE shared_links SET download_count = download_count + ? WHERE id = ?',
+                [(count, link_id) for (_, link_id), count in pending.items() if link_id is not None]
+            )
+            conn.commit()
+        except sqlite3.Error:
+            # Keep the counts for the next attempt
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+            raise
+        finally:
+            release_db()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error('Failed to flush download counts: %s', e)
+
+
+download_counter = DownloadCounter(DOWNLOAD_COUNT_FLUSH_INTERVAL)
+
+
+def increment_download_count(file_id, link_id=None):
+    """Count one download of a shared file, written to the database in batches"""
+    download_counter.increment(file_id, link_id)
+
+
+def get_user_files(user_id, folder='', recursive=False):
+    """Get files for a user, optionally filtered by folder and its subfolders"""
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if folder and recursive:
+        low, high = _subtree_range(folder)
+        cursor.execute(
+            '''SELECT * FROM files WHERE user_id = ?
+               AND (folder = ? OR (folder >= ? AND folder < ?))
+               ORDER BY uploaded_at DESC, id DESC''',
+            (user_id, folder, low, high)
+        )
+    elif folder:
         cursor.execute(
             '''SELECT * FROM files WHERE user_id = ? AND folder = ? 
-               ORDER BY uploaded_at DESC''',
+               ORDER BY uploaded_at DESC, id DESC''',
             (user_id, folder)
         )
     else:
         cursor.execute(
-            'SELECT * FROM files WHERE user_id = ? ORDER BY uploaded_at DESC',
+            'SELECT * FROM files WHERE user_id = ? ORDER BY uploaded_at DESC, id DESC',
             (user_id,)
         )
 
     files = cursor.fetchall()
-    conn.close()
     return files
+
+
+def get_user_files_by_ids(user_id, file_ids):
+    """Get a user's files among the given ids, newest first, ignoring others"""
+    conn = get_db()
+    cursor = conn.cursor()
+
+    files = []
+    file_ids = list(file_ids)
+    for start in range(0, len(file_ids), IDS_PER_QUERY):
+        chunk = file_ids[start:start + IDS_PER_QUERY]
+        cursor.execute(
+            f'''SELECT * FROM files WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})''',
+            (user_id, *chunk)
+        )
+        files.extend(cursor.fetchall())
+
+    files.sort(key=lambda file: (file['uploaded_at'], file['id']), reverse=True)
+    return files
+
+
+def get_user_files_page(user_id, folder='', after=None, limit=50):
+    """Get one page of user files, newest first
+
+    `after` is the (uploaded_at, id) key of the last file on the previous
+    page; the next page starts right below it in the index.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    conditions = ['user_id = ?']
+    params = [user_id]
+
+    if folder:
+        conditions.append('folder = ?')
+        params.append(folder)
+
+    if after is not None:
+        conditions.append('(uploaded_at, id) < (?, ?)')
+        params.extend(after)
+
+    params.append(limit)
+    cursor.execute(
+        f'''SELECT id, original_filename, file_size, file_type, mime_type, folder,
+                   {ACTIVE_SHARE_TOKEN_SQL} AS public_token, uploaded_at
+            FROM files WHERE {' AND '.join(conditions)}
+            ORDER BY uploaded_at DESC, id DESC LIMIT ?''',
+        params
+    )
+
+    return cursor.fetchall()
+
+
+def _search_terms(text):
+    """Split user input into tokens the search index understands"""
+    return re.findall(r'[^\W_]+', text.lower())
+
+
+def search_user_files(user_id, query='', file_types=(), folder='', before=None, limit=50):
+    """Search a user's files by name, folder and type, newest first
+
+    Every word of `query` matches as a prefix, so 'rep 20' finds
+    'report_2024.pdf'. `file_types` keeps only files with those extensions.
+    `before` is the id of the last file on the previous page.
+    """
+    terms = _search_terms(query)
+    types = [token for file_type in file_types for token in _search_terms(file_type)]
+    if not terms and not types:
+        return []
+
+    # Quoted tokens can't be read as FTS5 operators
+    match = [f'owner : "u{int(user_id)}"']
+    if terms:
+        columns = ' '.join(SEARCH_COLUMNS)
+        phrases = ' '.join(f'"{term}"*' for term in terms)
+        match.append(f'{{{columns}}} : ({phrases})')
+    if types:
+        alternatives = ' OR '.join(f'"{file_type}"' for file_type in types)
+        match.append(f'file_type : ({alternatives})')
+
+    conditions = ['files_search MATCH ?']
+    params = [' AND '.join(match)]
+
+    if folder:
+        conditions.append('files.folder = ?')
+        params.append(folder)
+
+    if before is not None:
+        conditions.append('files_search.rowid < ?')
+        params.append(before)
+
+    params.append(limit)
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    # The index walks its matches in rowid order, so newest first needs no
+    # sort and ranking every match of a short prefix isn't paid for
+    cursor.execute(
+        f'''SELECT files.id, files.original_filename, files.file_size, files.file_type,
+                   files.mime_type, files.folder, {ACTIVE_SHARE_TOKEN_SQL} AS public_token,
+                   files.uploaded_at
+            FROM files_search JOIN files ON files.id = files_search.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY files_search.rowid DESC LIMIT ?''',
+        params
+    )
+
+    return cursor.fetchall()
+
+
+def normalize_folder_path(folder):
+    """Clean a user-supplied folder path into 'a/b/c' form, '' for root"""
+    parts = [secure_filename(part) for part in (folder or '').replace('\\', '/').split('/')]
+    return '/'.join(part for part in parts if part)
+
+
+def _subtree_range(path):
+    """Bounds of the paths strictly below a folder, '/' sorts right before '0'"""
+    return path + '/', path + '0'
+
+
+def _ensure_folder(cursor, user_id, path):
+    """Create a folder and any missing ancestors, returns its id"""
+    parent_id = None
+    current = ''
+    for name in path.split('/'):
+        current = f'{current}/{name}' if current else name
+        cursor.execute(
+            'INSERT OR IGNORE INTO folders (user_id, parent_id, name, path) VALUES (?, ?, ?, ?)',
+            (user_id, parent_id, name, current)
+        )
+        cursor.execute('SELECT id FROM folders WHERE user_id = ? AND path = ?', (user_id, current))
+        parent_id = cursor.fetchone()[0]
+    return parent_id
+
+
+def ensure_folder(user_id, path):
+    """Make sure a folder path exists, creating it as needed"""
+    if not path:
+        return None
+    conn = get_db()
+    folder_id = _ensure_folder(conn.cursor(), user_id, path)
+    conn.commit()
+    return folder_id
+
+
+def add_folder(user_id, name, parent=''):
+    """Create a folder under an existing parent, returns its path
+
+    Returns None if the parent doesn't exist or the folder already does.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    parent_id = None
+    if parent:
+        parent_folder = get_folder(user_id, parent)
+        if not parent_folder:
+            return None
+        parent_id = parent_folder['id']
+
+    path = f'{parent}/{name}' if parent else name
+    try:
+        cursor.execute(
+            'INSERT INTO folders (user_id, parent_id, name, path) VALUES (?, ?, ?, ?)',
+            (user_id, parent_id, name, path)
+        )
+        conn.commit()
+        return path
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return None
+
+
+def get_folder(user_id, path):
+    """Get a folder by its path"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM folders WHERE user_id = ? AND path = ?', (user_id, path))
+    return cursor.fetchone()
+
+
+def get_user_folders(user_id, parent=None):
+    """Get folders with recursive sizes and file counts, ordered by path
+
+    With `parent` set only its direct children are returned, '' meaning
+    the top level. Sizes come from one grouped scan of the covering
+    (user_id, folder, file_size) index.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    if parent is None:
+        cursor.execute(
+            'SELECT id, parent_id, name, path FROM folders WHERE user_id = ? ORDER BY path',
+            (user_id,)
+        )
+        folders = cursor.fetchall()
+        cursor.execute(
+            '''SELECT folder, SUM(file_size), COUNT(*) FROM files
+               WHERE user_id = ? AND folder != '' GROUP BY folder''',
+            (user_id,)
+        )
+    else:
+        parent_folder = get_folder(user_id, parent) if parent else None
+        if parent and not parent_folder:
+            return []
+        cursor.execute(
+            '''SELECT id, parent_id, name, path FROM folders
+               WHERE user_id = ? AND parent_id IS ? ORDER BY name''',
+            (user_id, parent_folder['id'] if parent_folder else None)
+        )
+        folders = cursor.fetchall()
+        if parent:
+            low, high = _subtree_range(parent)
+            cursor.execute(
+                '''SELECT folder, SUM(file_size), COUNT(*) FROM files
+                   WHERE user_id = ? AND folder >= ? AND folder < ? GROUP BY folder''',
+                (user_id, low, high)
+            )
+        else:
+            cursor.execute(
+                '''SELECT folder, SUM(file_size), COUNT(*) FROM files
+                   WHERE user_id = ? AND folder != '' GROUP BY folder''',
+                (user_id,)
+            )
+
+    # Add each folder's own files to every folder above it
+    totals = {}
+    for folder, size, count in cursor.fetchall():
+        current = ''
+        for name in folder.split('/'):
+            current = f'{current}/{name}' if current else name
+            total = totals.setdefault(current, [0, 0])
+            total[0] += size
+            total[1] += count
+
+    return [
+        {
+            'id': folder['id'],
+            'parent_id': folder['parent_id'],
+            'name': folder['name'],
+            'path': folder['path'],
+            'size': totals.get(folder['path'], (0, 0))[0],
+            'file_count': totals.get(folder['path'], (0, 0))[1]
+        }
+        for folder in folders
+    ]
+
+
+def move_user_folder(user_id, path, new_parent, new_name):
+    """Move and/or rename a folder with everything below it
+
+    Only the rows of the subtree are touched, found through the path
+    indexes. Returns the new path, or None if the folder or new parent
+    doesn't exist, the target is taken or would be inside the folder.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    folder = get_folder(user_id, path)
+    if not folder:
+        return None
+
+    new_path = f'{new_parent}/{new_name}' if new_parent else new_name
+    if new_path == path:
+        return path
+    if new_parent == path or new_parent.startswith(path + '/'):
+        return None
+
+    parent_id = None
+    if new_parent:
+        parent_folder = get_folder(user_id, new_parent)
+        if not parent_folder:
+            return None
+        parent_id = parent_folder['id']
+
+    if get_folder(user_id, new_path):
+        return None
+
+    # Swap the old prefix for the new one on every path in the subtree
+    low, high = _subtree_range(path)
+    params = (new_path, len(path) + 1, user_id, path, low, high)
+    try:
+        cursor.execute(
+            '''UPDATE folders SET path = ? || substr(path, ?)
+               WHERE user_id = ? AND (path = ? OR (path >= ? AND path < ?))''',
+            params
+        )
+        cursor.execute(
+            'UPDATE folders SET parent_id = ?, name = ? WHERE id = ?',
+            (parent_id, new_name, folder['id'])
+        )
+        cursor.execute(
+            '''UPDATE files SET folder = ? || substr(folder, ?)
+               WHERE user_id = ? AND (folder = ? OR (folder >= ? AND folder < ?))''',
+            params
+        )
+        cursor.execute(
+            '''UPDATE upload_sessions SET folder = ? || substr(folder, ?)
+               WHERE user_id = ? AND (folder = ? OR (folder >= ? AND folder < ?))''',
+            params
+        )
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return None
+
+    # Cached file rows carry the old folder path
+    file_cache.clear()
+    return new_path
+
+
+def get_changes(user_id, since, limit):
+    """Get a user's journal entries after a cursor, oldest first
+
+    File entries carry the file's current row, NULL columns once it's gone.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        f'''SELECT changes.id, changes.item_type, changes.item_id, changes.action, changes.path,
+                  changes.changed_at, files.id AS file_id, files.original_filename, files.folder,
+                  files.file_size, files.file_type, files.mime_type, files.content_hash,
+                  {ACTIVE_SHARE_TOKEN_SQL} AS public_token, files.uploaded_at
+           FROM changes LEFT JOIN files
+               ON changes.item_type = 'file' AND files.id = changes.item_id AND files.user_id = changes.user_id
+           WHERE changes.user_id = ? AND changes.id > ?
+           ORDER BY changes.id LIMIT ?''',
+        (user_id, since, limit)
+    )
+    return cursor.fetchall()
+
+
+def get_latest_change_id(user_id):
+    """Get the id of a user's newest journal entry, 0 if there is none
+
+    Only the user's own entries count, so a cursor says nothing about how
+    busy other accounts are.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(id) FROM changes WHERE user_id = ?', (user_id,))
+    return cursor.fetchone()[0] or 0
+
+
+def prune_changes(cutoff, limit):
+    """Drop up to `limit` journal entries older than `cutoff`, returns how many
+
+    Entries are taken from the start of the journal, which ids keep in
+    time order, so no index on the timestamp is needed. The last pruned id
+    is kept as gc_state 'changes_pruned_through': cursors below it expired.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute(
+        'SELECT MAX(id) FROM (SELECT id, changed_at FROM changes ORDER BY id LIMIT ?) WHERE changed_at < ?',
+        (limit, cutoff)
+    )
+    last_id = cursor.fetchone()[0]
+    if last_id is None:
+        return 0
+
+    cursor.execute('DELETE FROM changes WHERE id <= ?', (last_id,))
+    count = cursor.rowcount
+    cursor.execute(
+        '''INSERT INTO gc_state (key, value) VALUES ('changes_pruned_through', ?)
+           ON CONFLICT (key) DO UPDATE SET value = excluded.value''',
+        (str(last_id),)
+    )
+    conn.commit()
+    return count
+
+
+def create_upload_session(upload_id, user_id, original_filename, folder, file_size, chunk_size, temp_path):
+    """Start a chunked upload, returns False if it would exceed the quota
+
+    Space claimed by the user's other unfinished uploads counts against the
+    quota too, so parallel sessions cannot overshoot it.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        INSERT INTO upload_sessions (id, user_id, original_filename, folder,
+                                     file_size, chunk_size, temp_path, last_activity)
+        SELECT ?, id, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP FROM users
+        WHERE id = ? AND used_bytes + ? + (
+            SELECT COALESCE(SUM(file_size), 0) FROM upload_sessions WHERE user_id = ?
+        ) <= storage_limit
+    ''', (upload_id, original_filename, folder, file_size, chunk_size, temp_path,
+          user_id, file_size, user_id))
+
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def get_upload_session(upload_id, user_id):
+    """Get a chunked upload owned by a user"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?',
+        (upload_id, user_id)
+    )
+    return cursor.fetchone()
+
+
+def add_upload_chunk(upload_id, chunk_index):
+    """Mark one chunk of an upload as received, returns False if the upload is gone"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE upload_sessions SET last_activity = CURRENT_TIMESTAMP WHERE id = ?',
+        (upload_id,)
+    )
+    if cursor.rowcount == 0:
+        # Completed or cancelled while the chunk was being written
+        conn.rollback()
+        return False
+    cursor.execute(
+        'INSERT OR IGNORE INTO upload_chunks (upload_id, chunk_index) VALUES (?, ?)',
+        (upload_id, chunk_index)
+    )
+    conn.commit()
+    return True
+
+
+def get_upload_chunks(upload_id):
+    """Get the indexes of received chunks"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT chunk_index FROM upload_chunks WHERE upload_id = ? ORDER BY chunk_index',
+        (upload_id,)
+    )
+    return [row['chunk_index'] for row in cursor.fetchall()]
+
+
+def claim_upload_session(upload_id, user_id):
+    """Take a chunked upload for completing it, returns None if it's gone
+
+    The session and its chunks are deleted in the same transaction, so of
+    concurrent completions only one gets the session.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'DELETE FROM upload_sessions WHERE id = ? AND user_id = ? RETURNING *',
+        (upload_id, user_id)
+    )
+    upload = cursor.fetchone()
+    if upload is not None:
+        cursor.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+    conn.commit()
+    return upload
+
+
+def delete_upload_session(upload_id):
+    """Forget a chunked upload and its chunks"""
+    conn = get_db()
+    conn.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+    conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    conn.commit()
+
+
+def get_expired_upload_sessions(max_age_seconds):
+    """Get chunked uploads that received nothing for max_age_seconds"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT * FROM upload_sessions WHERE last_activity < datetime('now', ?)",
+        (f'-{int(max_age_seconds)} seconds',)
+    )
+    return cursor.fetchall()
+
+
+def get_thumbnail_status(source_key):
+    """Get whether thumbnails for a source are pending, ready or failed"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT status FROM thumbnails WHERE source_key = ?', (source_key,))
+    row = cursor.fetchone()
+    return row['status'] if row else None
+
+
+def claim_thumbnails(source_key, pending_timeout, failed_retry):
+    """Mark thumbnails as pending, returns True if the caller should render them
+
+    Sources that are ready or already being rendered are left alone; jobs
+    pending for longer than pending_timeout seconds count as lost, and
+    failed ones are tried again after failed_retry seconds.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO thumbnails (source_key, status) VALUES (?, 'pending')
+        ON CONFLICT (source_key) DO UPDATE SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+        WHERE (status = 'pending' AND updated_at < datetime('now', ?))
+            OR (status = 'failed' AND updated_at < datetime('now', ?))
+    ''', (source_key, f'-{int(pending_timeout)} seconds', f'-{int(failed_retry)} seconds'))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def forget_thumbnails(source_key, status):
+    """Drop a source's entry if it still has the given status, so it's claimed afresh"""
+    conn = get_db()
+    conn.execute('DELETE FROM thumbnails WHERE source_key = ? AND status = ?', (source_key, status))
+    conn.commit()
+
+
+def set_thumbnail_status(source_key, status):
+    """Record the outcome of rendering thumbnails"""
+    conn = get_db()
+    conn.execute(
+        'UPDATE thumbnails SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE source_key = ?',
+        (status, source_key)
+    )
+    conn.commit()
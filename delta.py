@@ -0,0 +1,149 @@
+"""rsync-style delta uploads of new versions of stored files
+
+The client fetches the signature of a file it already uploaded: per
+block an Adler-32 checksum (zlib.adler32, which a client can roll over
+its own file byte by byte) and a SHA-256 digest. It then sends
+instructions that copy matching blocks from the stored file, plus the
+bytes that matched nothing, and the server rebuilds the new version:
+
+    [["copy", first_block, block_count], ["data", length], ...]
+
+"data" instructions consume the uploaded literal bytes in order.
+"""
+import hashlib
+import json
+import struct
+import zlib
+
+import blobstore
+from config import DELTA_BLOCK_SIZE, DELTA_MAX_BLOCKS, UPLOAD_MAX_FILE_SIZE, UPLOAD_STREAM_BLOCK_SIZE
+from database import get_block_signature, save_block_signature
+
+# One signature entry: Adler-32, then the SHA-256 digest
+_ENTRY = struct.Struct('>I32s')
+
+
+def block_size_for(size):
+    """Get the block size of a file's signature, larger for larger files"""
+    block_size = DELTA_BLOCK_SIZE
+    while size > block_size * DELTA_MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def _read_block(source, size):
+    """Read up to size bytes, short only at the end of the source"""
+    parts = []
+    while size > 0:
+        data = source.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def compute_signature(source, block_size):
+    """Get the packed signature of a readable file"""
+    entries = []
+    while True:
+        block = _read_block(source, block_size)
+        if not block:
+            break
+        entries.append(_ENTRY.pack(zlib.adler32(block), hashlib.sha256(block).digest()))
+    return b''.join(entries)
+
+
+def get_signature(file):
+    """Get the block size and packed signature of a stored file
+
+    Signatures of blobs are cached, their content never changes. Raises
+    FileNotFoundError if the file isn't in storage.
+    """
+    block_size = block_size_for(file['file_size'])
+    content_hash = file['content_hash']
+    if content_hash:
+        signature = get_block_signature(content_hash, block_size)
+        if signature is not None:
+            return block_size, signature
+
+    with blobstore.open_blob(file['filepath'], file['encoding']) as source:
+        signature = compute_signature(source, block_size)
+
+    if content_hash:
+        save_block_signature(content_hash, block_size, signature)
+    return block_size, signature
+
+
+def unpack_signature(signature):
+    """Get [adler32, sha256 hex] pairs of a packed signature"""
+    return [[weak, strong.hex()] for weak, strong in _ENTRY.iter_unpack(signature)]
+
+
+def parse_instructions(text, base_size, block_size, literal_size):
+    """Validate delta instructions, returns ('copy', offset, length) and ('data', length) steps
+
+    Adjacent copies are merged into one read. Raises ValueError with a
+    message for the client when the instructions don't fit the files.
+    """
+    try:
+        instructions = json.loads(text)
+    except ValueError:
+        raise ValueError('Instructions must be JSON')
+    if not isinstance(instructions, list):
+        raise ValueError('Instructions must be a list')
+
+    block_count = -(-base_size // block_size)
+    steps = []
+    total_size = 0
+    data_size = 0
+    for instruction in instructions:
+        if not isinstance(instruction, list) or not instruction:
+            raise ValueError('Each instruction must be a list')
+        kind, arguments = instruction[0], instruction[1:]
+        if not all(type(argument) is int and argument >= 0 for argument in arguments):
+            raise ValueError('Instruction arguments must be non-negative integers')
+
+        if kind == 'copy' and len(arguments) == 2:
+            first_block, count = arguments
+            if count == 0 or first_block + count > block_count:
+                raise ValueError(f'Blocks out of range, the file has {block_count}')
+            offset = first_block * block_size
+            length = min(count * block_size, base_size - offset)
+            if steps and steps[-1][0] == 'copy' and steps[-1][1] + steps[-1][2] == offset:
+                steps[-1] = ('copy', steps[-1][1], steps[-1][2] + length)
+            else:
+                steps.append(('copy', offset, length))
+        elif kind == 'data' and len(arguments) == 1:
+            length = arguments[0]
+            data_size += length
+            steps.append(('data', length))
+        else:
+            raise ValueError(f'Unknown instruction {kind!r}')
+
+        total_size += length
+        if total_size > UPLOAD_MAX_FILE_SIZE:
+            raise ValueError('File is too large')
+
+    if data_size != literal_size:
+        raise ValueError(f'Instructions use {data_size} bytes of data, {literal_size} were sent')
+    return steps
+
+
+def _copy(source, target, length):
+    while length > 0:
+        block = source.read(min(UPLOAD_STREAM_BLOCK_SIZE, length))
+        if not block:
+            raise ValueError('Source ended early')
+        target.write(block)
+        length -= len(block)
+
+
+def apply_delta(base, literal, steps, target):
+    """Write the new version to target from the stored file and the literal bytes"""
+    for step in steps:
+        if step[0] == 'copy':
+            base.seek(step[1])
+            _copy(base, target, step[2])
+        else:
+            _copy(literal, target, step[1])
@@ -0,0 +1,74 @@
+import json
+import logging
+import random
+import sys
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE
+
+# Attributes every LogRecord has, anything else came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class SampleFilter(logging.Filter):
+    """Keep only a fraction of DEBUG and INFO records, warnings always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class StructuredFormatter(logging.Formatter):
+    """One record per line, as JSON or as key=value pairs
+
+    Fields passed with `extra` become keys of their own, so logs can be
+    filtered by user, folder or file without parsing messages.
+    """
+
+    def __init__(self, as_json):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_')
+        )
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+
+        if self.as_json:
+            return json.dumps(fields, default=str, ensure_ascii=False)
+        return ' '.join(f'{key}={json.dumps(value, default=str, ensure_ascii=False)}'
+                        for key, value in fields.items())
+
+
+def configure_logging():
+    """Send the application's logs to stderr at the configured level
+
+    Records below LOG_LEVEL are dropped by logger.debug() itself before any
+    formatting, so disabled debug logging only costs a level check.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(LOG_FORMAT == 'json'))
+    if LOG_DEBUG_SAMPLE_RATE < 1:
+        handler.addFilter(SampleFilter(LOG_DEBUG_SAMPLE_RATE))
+
+    logger = logging.getLogger('cloude')
+    logger.setLevel(LOG_LEVEL)
+    logger.handlers = [handler]
+    logger.propagate = False
+    return logger
+
+
+def get_logger(name):
+    """Get a logger below the application's own"""
+    return logging.getLogger(f'cloude.{name}')
@@ -0,0 +1,214 @@
+import bisect
+import math
+import threading
+import time
+
+from config import METRICS_LATENCY_BUCKETS
+
+
+def _format_labels(names, values):
+    """Render a label set in the Prometheus text format"""
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, optionally split by labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([*counts], total, count) for key, (counts, total, count) in self._values.items()}
+        names = self.labels + ('le',)
+        for label_values, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket',
+                       _format_labels(names, label_values + (_format_value(bound),)), cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class CallbackMetric:
+    """Metric read from a callback when metrics are scraped
+
+    The callback returns a number, or a dict of label values to numbers,
+    so values other code already keeps don't need to be tracked twice.
+    """
+
+    def __init__(self, name, documentation, callback, labels=(), kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request until the response starts',
+    ('endpoint', 'method', 'status')
+))
+request_bytes = registry.register(Counter(
+    'http_request_bytes_total', 'Request body bytes received, uploads included', ('endpoint',)
+))
+response_bytes = registry.register(Counter(
+    'http_response_bytes_total', 'Response body bytes sent by the application, downloads included', ('endpoint',)
+))
+request_queries = registry.register(Histogram(
+    'db_queries_per_request', 'SQLite statements executed per request', ('endpoint',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100)
+))
+request_query_time = registry.register(Histogram(
+    'db_query_seconds_per_request', 'Time spent in SQLite per request', ('endpoint',)
+))
+queries = registry.register(Counter(
+    'db_queries_total', 'SQLite statements executed, background work included'
+))
+query_time = registry.register(Counter(
+    'db_query_seconds_total', 'Time spent in SQLite, background work included'
+))
+thumbnail_duration = registry.register(Histogram(
+    'thumbnail_render_seconds', 'Time to render every thumbnail size of an image', ('status',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+))
+
+
+# Statement counts of the request running on each thread
+_local = threading.local()
+
+
+def record_query(elapsed, count=1):
+    """Record time spent in SQLite, called by the database layer
+
+    Fetching rows and committing add time without counting a statement.
+    """
+    if count:
+        queries.inc(count)
+    query_time.inc(elapsed)
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[0] += count
+        stats[1] += elapsed
+
+
+def start_request():
+    """Start timing a request on this thread"""
+    _local.stats = [0, 0.0]
+    _local.started = time.perf_counter()
+
+
+def finish_request(endpoint, method, status, bytes_in, bytes_out):
+    """Record a finished request, returns its duration"""
+    stats = getattr(_local, 'stats', None)
+    started = getattr(_local, 'started', None)
+    _local.stats = None
+    if stats is None or started is None:
+        return None
+
+    elapsed = time.perf_counter() - started
+    request_duration.observe(elapsed, endpoint, method, status)
+    request_queries.observe(stats[0], endpoint)
+    request_query_time.observe(stats[1], endpoint)
+    if bytes_in:
+        request_bytes.inc(bytes_in, endpoint)
+    if bytes_out:
+        response_bytes.inc(bytes_out, endpoint)
+    return elapsed
+
+
+def count_streamed(chunks, endpoint):
+    """Count the bytes of a streamed response as they are sent"""
+    for chunk in chunks:
+        response_bytes.inc(len(chunk), endpoint)
+        yield chunk
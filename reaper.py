@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+
+import blobstore
+import thumbnails
+from config import (UPLOAD_FOLDER, BLOB_FOLDER, THUMBNAIL_FOLDER, UPLOAD_TMP_FOLDER, UPLOAD_SESSION_TTL,
+                    REAPER_INTERVAL, REAPER_BATCH_SIZE, GC_INTERVAL, GC_BATCH_SIZE, GC_GRACE_PERIOD,
+                    CHANGES_RETENTION)
+from database import (reap_deleted_files, remove_orphans, get_blob_hashes, get_gc_state, set_gc_state,
+                      prune_changes, delete_expired_share_links, release_db)
+from logs import get_logger
+from storage import storage
+
+logger = get_logger('reaper')
+
+
+def _remove_storage(keys, thumbnail_keys):
+    """Delete the bytes of reaped files and their thumbnails"""
+    for key in keys:
+        blobstore.remove(key)
+    for key in thumbnail_keys:
+        thumbnails.remove_thumbnails(key)
+
+
+def reap_deleted(limit=REAPER_BATCH_SIZE):
+    """Remove the storage of deleted files until the queue is empty, returns how many"""
+    total = 0
+    while True:
+        count = reap_deleted_files(limit, _remove_storage)
+        total += count
+        if count < limit:
+            return total
+
+
+def prune_journal(limit=REAPER_BATCH_SIZE):
+    """Drop change journal entries past CHANGES_RETENTION, returns how many"""
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - CHANGES_RETENTION))
+    total = 0
+    while True:
+        count = prune_changes(cutoff, limit)
+        total += count
+        if count < limit:
+            return total
+
+
+def sweep_share_links(limit=REAPER_BATCH_SIZE):
+    """Remove expired share links in batches, returns how many"""
+    total = 0
+    while True:
+        count = delete_expired_share_links(limit)
+        total += count
+        if count < limit:
+            return total
+
+
+def _walk_after(root, after, parts=()):
+    """Yield (path parts, entry) for files below root in order, after a cursor
+
+    Paths are compared part by part, which is the order the walk visits
+    them in, so directories before the cursor are skipped unopened.
+    """
+    try:
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except OSError:
+        return
+
+    for entry in entries:
+        entry_parts = parts + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            if entry_parts < after[:len(entry_parts)]:
+                continue
+            yield from _walk_after(entry.path, after, entry_parts)
+        elif entry_parts > after:
+            yield entry_parts, entry
+
+
+def _classify(parts, entry, now):
+    """Get what an entry on disk should be checked against
+
+    Returns (kind, key, path) for remove_orphans, 'temp' for leftover
+    temporary files, or None for anything too young or unknown.
+    """
+    top, name = parts[0], parts[-1]
+    try:
+        age = now - entry.stat(follow_symlinks=False).st_mtime
+    except OSError:
+        return None
+
+    if top == os.path.basename(UPLOAD_TMP_FOLDER):
+        # Unfinished chunked uploads live as long as their session
+        if age < UPLOAD_SESSION_TTL:
+            return None
+        return 'incoming', entry.path, entry.path
+
+    if age < GC_GRACE_PERIOD:
+        return None
+
+    if top == os.path.basename(BLOB_FOLDER):
+        return 'blob', name, entry.path
+    if top == os.path.basename(THUMBNAIL_FOLDER):
+        if name.endswith('.tmp'):
+            return 'temp'
+        key = name.rsplit('.', 1)[0].rsplit('-', 1)[0]
+        return 'thumbnail', key, entry.path
+    if top.isdigit():
+        # Stored before the blob store, under the owner's id
+        return 'file', name, entry.path
+    return None
+
+
+def _classify_object(stored, now):
+    """Get what an object in a remote backend should be checked against"""
+    if now - stored.mtime < GC_GRACE_PERIOD:
+        return None
+    parts = stored.key.split('/')
+    if parts[0] == blobstore.BLOB_PREFIX:
+        return 'blob', parts[-1], stored.key
+    if parts[0].isdigit():
+        return 'file', parts[-1], stored.key
+    return None
+
+
+def collect_orphans(limit=GC_BATCH_SIZE):
+    """Check the next batch of the current collector pass
+
+    A pass first walks UPLOAD_FOLDER removing files nothing refers to, then
+    lists a remote backend's objects the same way if there is one, then
+    checks every blob still has its file. Returns True when a pass ends.
+    """
+    phase = get_gc_state('phase', 'files')
+    cursor = get_gc_state('cursor')
+
+    if phase == 'blobs':
+        hashes = get_blob_hashes(cursor, limit)
+        for content_hash in hashes:
+            if not storage.exists(blobstore.blob_key(content_hash)):
+                logger.error('Blob is referenced but missing from storage', extra={'content_hash': content_hash})
+
+        if len(hashes) < limit:
+            set_gc_state(phase='files', cursor='', finished_at=time.time())
+            return True
+        set_gc_state(cursor=hashes[-1])
+        return False
+
+    if phase == 'objects':
+        now = time.time()
+        objects = storage.list(cursor, limit)
+        candidates = [target for target in (_classify_object(stored, now) for stored in objects) if target]
+
+        removed = remove_orphans(candidates, blobstore.remove)
+        if removed:
+            logger.info('Removed orphaned objects', extra={'count': len(removed)})
+
+        if len(objects) < limit:
+            set_gc_state(phase='blobs', cursor='')
+        else:
+            set_gc_state(cursor=objects[-1].key)
+        return False
+
+    after = tuple(cursor.split('/')) if cursor else ()
+    now = time.time()
+    candidates = []
+    last = None
+    scanned = 0
+    for parts, entry in _walk_after(UPLOAD_FOLDER, after):
+        last = parts
+        scanned += 1
+
+        target = _classify(parts, entry, now)
+        if target == 'temp':
+            blobstore.discard(entry.path)
+        elif target:
+            candidates.append(target)
+
+        if scanned >= limit:
+            break
+
+    removed = remove_orphans(candidates, blobstore.discard)
+    if removed:
+        logger.info('Removed orphaned files', extra={'count': len(removed)})
+
+    if scanned < limit:
+        set_gc_state(phase='objects' if storage.remote else 'blobs', cursor='')
+    else:
+        set_gc_state(cursor='/'.join(last))
+    return False
+
+
+def collect_all_orphans():
+    """Run a whole collector pass now, returns how many batches it took"""
+    batches = 1
+    while not collect_orphans():
+        batches += 1
+    return batches
+
+
+class StorageReaper:
+    """Background thread that reaps deleted files and collects orphans
+
+    Runs every REAPER_INTERVAL seconds, or right away when woken after a
+    delete. Each run empties the deletion queue, prunes the change journal,
+    removes expired share links and, while a collector pass is due or in
+    progress, checks one batch of it.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread unless it's running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='storage-reaper', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Reap now instead of at the next interval"""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                reap_deleted()
+                prune_journal()
+                sweep_share_links()
+                if self._collection_due():
+                    collect_orphans()
+            except Exception:
+                logger.exception('Storage reaper failed')
+            finally:
+                release_db()
+
+    def _collection_due(self):
+        """Check whether a collector pass is in progress or should start"""
+        if get_gc_state('phase', 'files') != 'files' or get_gc_state('cursor'):
+            return True
+        finished_at = float(get_gc_state('finished_at', '0'))
+        return time.time() - finished_at >= GC_INTERVAL
+
+
+storage_reaper = StorageReaper(REAPER_INTERVAL)
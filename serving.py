@@ -0,0 +1,258 @@
+import hashlib
+import hmac
+import os
+import uuid
+from urllib.parse import quote
+
+from flask import Response, abort, request, send_file
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import FileWrapper
+
+import blobstore
+from config import (SECRET_KEY, FILE_CACHE_MAX_AGE, MAX_BYTE_RANGES, UPLOAD_STREAM_BLOCK_SIZE, UPLOAD_FOLDER,
+                    FILE_SERVING_BACKEND, FILE_ACCEL_REDIRECT_PREFIX)
+from storage import storage
+
+
+def file_etag(file, stat=None):
+    """Strong validator for a stored file
+
+    Blob-backed files use a keyed hash of their id and content hash: the
+    content hash itself must never leave the server, with it anyone could
+    claim the blob through hash-only uploads. Older files fall back to
+    mtime and size, or their unique stored name when they aren't on the
+    local disk. Either is good enough since stored files never change.
+    """
+    if file['content_hash']:
+        message = f"{file['id']}:{file['content_hash']}".encode()
+        return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+    if stat is None:
+        return file['filename']
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+
+def send_stored_file(file, path=None, mimetype=None, as_attachment=False, download_name=None):
+    """Serve a stored file with validators, range support and long caching
+
+    `path` and `mimetype` default to the file's own, thumbnails pass the
+    local path and type of theirs.
+    """
+    key = None
+    if path is None:
+        key = file['filepath']
+        path = storage.local_path(key)
+    mimetype = mimetype or file['mime_type']
+
+    # Remote backends have no path, the row has what's needed then
+    stat = os.stat(path) if path else None
+    etag = file_etag(file, stat)
+    encoding = None
+    if key is None:
+        # Derived files such as thumbnails get their own validator
+        etag = f'{etag}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    elif file['encoding']:
+        if not request.accept_encodings[file['encoding']]:
+            return _send_decoded(file, key, mimetype, etag, stat, as_attachment, download_name)
+        # The compressed bytes are sent as they are, a representation of
+        # their own with its own validator
+        encoding = file['encoding']
+        etag = f'{etag}-{encoding}'
+
+    # Proxies wouldn't pass the Content-Encoding on
+    offload = None if encoding or not path else _offload_header(path)
+    ranges = None if offload or encoding or not path else _multiple_ranges(stat.st_size, etag, stat.st_mtime)
+
+    if not path:
+        response = _send_remote(file, key, mimetype, etag, as_attachment, download_name)
+    elif offload:
+        # The proxy sends the bytes and handles ranges, the worker is free
+        # as soon as the headers are out
+        response = Response(mimetype=mimetype)
+        response.headers[offload[0]] = offload[1]
+        if as_attachment:
+            response.headers['Content-Disposition'] = _attachment_header(download_name or os.path.basename(path))
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.make_conditional(request)
+    elif ranges:
+        response = _send_byteranges(path, mimetype, ranges, stat.st_size)
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+    else:
+        # Werkzeug handles If-None-Match, If-Modified-Since, If-Range and
+        # single ranges on its own, and hands the file to wsgi.file_wrapper
+        # so servers that support it send it with os.sendfile
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=True,
+            etag=etag,
+            last_modified=stat.st_mtime,
+            max_age=FILE_CACHE_MAX_AGE
+        )
+
+    if encoding:
+        response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+
+    # Advertise ranges on full responses too, so downloads can resume
+    response.accept_ranges = 'bytes'
+
+    # A file id always refers to the same bytes, but access is per user
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.max_age = FILE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def _send_remote(file, key, mimetype, etag, as_attachment, download_name):
+    """Stream a file from a remote backend through the worker
+
+    Werkzeug answers conditional and single range requests, seeking the
+    object reader to the start of the range.
+    """
+    try:
+        reader = storage.open(key)
+    except FileNotFoundError:
+        abort(404)
+
+    size = file['stored_size'] or file['file_size']
+    response = Response(FileWrapper(reader, UPLOAD_STREAM_BLOCK_SIZE), mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = size
+    if as_attachment:
+        response.headers['Content-Disposition'] = _attachment_header(download_name or os.path.basename(key))
+    response.set_etag(etag)
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def _send_decoded(file, key, mimetype, etag, stat, as_attachment, download_name):
+    """Stream a compressed file decompressed, for clients without the codec
+
+    The original length is known, so single ranges are served too:
+    werkzeug seeks the decompressing reader to the start of the range,
+    which decompresses and skips everything before it.
+    """
+    try:
+        source = blobstore.open_blob(key, file['encoding'])
+    except FileNotFoundError:
+        abort(404)
+
+    response = Response(FileWrapper(source, UPLOAD_STREAM_BLOCK_SIZE), mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = file['file_size']
+    if as_attachment:
+        response.headers['Content-Disposition'] = _attachment_header(download_name or os.path.basename(key))
+    response.set_etag(etag)
+    if stat:
+        response.last_modified = stat.st_mtime
+    response.vary.add('Accept-Encoding')
+    # Advertised on full responses too, so downloads can resume
+    response.accept_ranges = 'bytes'
+    response.cache_control.private = True
+    response.cache_control.max_age = FILE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=file['file_size'])
+
+
+def _offload_header(path):
+    """Get the header that hands a file to the fronting proxy, else None"""
+    if FILE_SERVING_BACKEND == 'x-sendfile':
+        return 'X-Sendfile', os.path.abspath(path)
+
+    if FILE_SERVING_BACKEND == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, UPLOAD_FOLDER)
+        if relative_path.startswith('..'):
+            # Only UPLOAD_FOLDER is mapped in the proxy
+            return None
+        return 'X-Accel-Redirect', FILE_ACCEL_REDIRECT_PREFIX + quote(relative_path.replace(os.sep, '/'))
+
+    return None
+
+
+def _attachment_header(filename):
+    """Content-Disposition for a download, non-ASCII names as RFC 2231"""
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(filename, safe='')}"
+    return 'attachment; filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _multiple_ranges(length, etag, mtime):
+    """Get the ranges of a satisfiable multi-range request, else None
+
+    Single ranges and anything conditional that doesn't hold are left to
+    send_file.
+    """
+    header = request.headers.get('Range')
+    if not header or ',' not in header or request.method != 'GET':
+        return None
+
+    # A revalidation that matches ends in a 304 from send_file instead
+    if request.if_none_match.contains(etag):
+        return None
+
+    # If-Range asks for the full body when the file changed
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None
+    if if_range.date and if_range.date.timestamp() < int(mtime):
+        return None
+
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes' or len(parsed.ranges) > MAX_BYTE_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+
+    return ranges or None
+
+
+def _send_byteranges(path, mimetype, ranges, length):
+    """Stream a multipart/byteranges response for several ranges"""
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\n'
+         f'Content-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n').encode()
+        for start, stop in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+
+    content_length = (sum(len(h) for h in part_headers)
+                      + sum(stop - start for start, stop in ranges)
+                      + 2 * (len(ranges) - 1) + len(closing))
+
+    def generate():
+        with open(path, 'rb') as f:
+            for index, (header, (start, stop)) in enumerate(zip(part_headers, ranges)):
+                if index:
+                    yield b'\r\n'
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining:
+                    block = f.read(min(UPLOAD_STREAM_BLOCK_SIZE, remaining))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+        yield closing
+
+    response = Response(generate(), status=206,
+                        mimetype=f'multipart/byteranges; boundary={boundary}',
+                        direct_passthrough=True)
+    response.content_length = content_length
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
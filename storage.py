@@ -0,0 +1,202 @@
+"""Where stored file bytes live, behind one small driver interface
+
+Files are referenced by a key relative to the backend's root, such as
+`.blobs/ab/cd/abcd...`. Temporary files, thumbnails and other derived data
+stay on the local disk whatever the backend.
+"""
+import os
+from collections import namedtuple
+
+from config import (UPLOAD_FOLDER, STORAGE_BACKEND, S3_BUCKET, S3_PREFIX,
+                    S3_ENDPOINT_URL, S3_REGION, S3_MULTIPART_CHUNK_SIZE, S3_MULTIPART_CONCURRENCY)
+
+StoredObject = namedtuple('StoredObject', 'key size mtime')
+
+
+class LocalStorage:
+    """Files below a directory on the local disk
+
+    Absolute keys are used as they are, files stored before keys were
+    relative still have them.
+    """
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        """Get the path of a key on disk, None for remote backends"""
+        return os.path.join(self.root, key)
+
+    def put(self, key, source_path):
+        """Move a local file into storage under a key"""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    def open(self, key):
+        """Open a key for reading, raises FileNotFoundError if it's missing"""
+        return open(self.local_path(key), 'rb')
+
+    def stat(self, key):
+        """Get the size and modification time of a key, None if it's missing"""
+        try:
+            stat = os.stat(self.local_path(key))
+        except FileNotFoundError:
+            return None
+        return StoredObject(key, stat.st_size, stat.st_mtime)
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key):
+        """Remove a key if it is still there"""
+        try:
+            os.remove(self.local_path(key))
+        except OSError:
+            pass
+
+
+class _S3ObjectReader:
+    """Seekable reader of an object, fetching from the current position on
+
+    Each seek past what was read starts a new ranged GET, so serving a
+    range or resuming costs one request.
+    """
+
+    def __init__(self, client, bucket, key):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._position = 0
+        self._body = None
+        self._open()
+
+    def _open(self):
+        try:
+            response = self._client.get_object(Bucket=self._bucket, Key=self._key,
+                                               Range=f'bytes={self._position}-')
+        except self._client.exceptions.NoSuchKey:
+            raise FileNotFoundError(self._key)
+        except self._client.exceptions.ClientError as e:
+            # Ranges at the end of an object are unsatisfiable, nothing is left
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            self._body = None
+            return
+        self._body = response['Body']
+
+    def read(self, size=-1):
+        if self._body is None:
+            return b''
+        data = self._body.read(size if size is not None and size >= 0 else None)
+        self._position += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence != os.SEEK_SET:
+            raise OSError('Only seeking from the start or current position is supported')
+        if offset != self._position:
+            self.close()
+            self._position = offset
+            self._open()
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, such as AWS S3 or MinIO
+
+    Credentials come from the usual boto3 sources, AWS_ACCESS_KEY_ID and
+    AWS_SECRET_ACCESS_KEY in the environment for instance. Large files are
+    uploaded as multipart uploads with parts sent in parallel.
+    """
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND 's3' needs boto3, pip install boto3")
+
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND 's3' needs S3_BUCKET")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=S3_MULTIPART_CONCURRENCY
+        )
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def put(self, key, source_path):
+        self.client.upload_file(source_path, self.bucket, self._object_key(key), Config=self.transfer_config)
+        os.remove(source_path)
+
+    def open(self, key):
+        return _S3ObjectReader(self.client, self.bucket, self._object_key(key))
+
+    def stat(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return StoredObject(key, response['ContentLength'], response['LastModified'].timestamp())
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def list(self, after='', limit=1000):
+        """Get up to `limit` objects in key order, starting after a key"""
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix, MaxKeys=limit,
+                                               StartAfter=self._object_key(after))
+        return [StoredObject(item['Key'][len(self.prefix):], item['Size'], item['LastModified'].timestamp())
+                for item in response.get('Contents', [])]
+
+
+def _create_storage():
+    if STORAGE_BACKEND == 'local':
+        return LocalStorage(UPLOAD_FOLDER)
+    if STORAGE_BACKEND == 's3':
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+    raise RuntimeError(f'Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}')
+
+
+storage = _create_storage()
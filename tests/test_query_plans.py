@@ -0,0 +1,114 @@
+"""EXPLAIN QUERY PLAN checks of the queries run per request and per reaper pass
+
+Each test runs the real database functions against a scratch database
+and asserts none of the statements they send scans a whole table.
+"""
+import pytest
+
+import database
+
+STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE_PATH', str(tmp_path / 'database.db'))
+    database.init_db()
+    yield database.get_db()
+
+    database.release_db()
+    while not database._pool.empty():
+        database._pool.get_nowait().close()
+
+
+@pytest.fixture
+def user_id(db):
+    database.create_user('alice', 'alice@example.com', 'correct horse')
+    user_id = database.get_user_by_username('alice')['id']
+    for number in range(3):
+        database.add_file(user_id, f'stored{number}', f'file{number}.txt', f'stored{number}', 10,
+                          'txt', 'text/plain', folder='docs', content_hash=f'{number:064x}', stored_size=10)
+    return user_id
+
+
+def traced(db, call):
+    """Run a call, returns its result and the statements it sent"""
+    statements = []
+    db.set_trace_callback(statements.append)
+    try:
+        result = call()
+    finally:
+        db.set_trace_callback(None)
+    return result, [sql for sql in statements if sql.lstrip().upper().startswith(STATEMENTS)]
+
+
+def table_scans(db, statements, bounded=()):
+    """Get the full table scans in the plans of some statements
+
+    Tables in `bounded` are queues read from the front in rowid order
+    under a LIMIT, their scan stops after that many rows.
+    """
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    scans = []
+    for sql in statements:
+        for row in db.execute('EXPLAIN QUERY PLAN ' + sql):
+            detail = row[3].split()
+            if detail[0] == 'SCAN' and detail[1] in tables and detail[1] not in bounded:
+                scans.append((' '.join(detail), sql))
+    return scans
+
+
+def assert_no_scans(db, call, bounded=()):
+    result, statements = traced(db, call)
+    assert statements, 'nothing was sent to the database'
+    assert table_scans(db, statements, bounded) == []
+    return result
+
+
+def test_keyset_listing(db, user_id):
+    first = assert_no_scans(db, lambda: database.get_user_files_page(user_id, limit=2))
+    after = (first[-1]['uploaded_at'], first[-1]['id'])
+    assert_no_scans(db, lambda: database.get_user_files_page(user_id, after=after, limit=2))
+    assert_no_scans(db, lambda: database.get_user_files_page(user_id, folder='docs', after=after, limit=2))
+
+
+def test_share_token_lookup(db, user_id):
+    token = database.create_share_token(1, user_id)
+    link = assert_no_scans(db, lambda: database.get_share_link(token))
+    assert link['file_id'] == 1
+
+
+def test_changes(db, user_id):
+    changes = assert_no_scans(db, lambda: database.get_changes(user_id, 0, 100))
+    assert len(changes) >= 3
+    latest = assert_no_scans(db, lambda: database.get_latest_change_id(user_id))
+    assert latest == changes[-1]['id']
+
+
+def test_legacy_filename(db, user_id):
+    entries = [('file', 'stored9', 'stored9')]
+    removed = assert_no_scans(db, lambda: database.remove_orphans(entries, lambda path: None))
+    assert removed == ['stored9']
+
+
+def test_orphan_checks(db, user_id):
+    entries = [(kind, 'missing', f'{kind}/missing') for kind in database.ORPHAN_CHECKS]
+    assert_no_scans(db, lambda: database.remove_orphans(entries, lambda path: None))
+    assert_no_scans(db, lambda: database.get_blob_hashes(limit=10))
+
+
+def test_cleanup_queries(db, user_id):
+    database.delete_file(1, user_id)
+    database.create_share_token(2, user_id, expires_in=-60)
+
+    reaped = assert_no_scans(db, lambda: database.reap_deleted_files(100, lambda paths, keys: None),
+                             bounded={'pending_deletes'})
+    assert reaped == 1
+    assert assert_no_scans(db, lambda: database.delete_expired_share_links(100)) == 1
+    assert_no_scans(db, lambda: database.prune_changes('9999-12-31 00:00:00', 100), bounded={'changes'})
+    assert_no_scans(db, lambda: database.get_expired_upload_sessions(60))
+
+
+def test_selected_files(db, user_id):
+    files = assert_no_scans(db, lambda: database.get_user_files_by_ids(user_id, range(1, 1200)))
+    assert [file['id'] for file in files] == [3, 2, 1]
@@ -0,0 +1,168 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+import blobstore
+from config import (THUMBNAIL_FOLDER, THUMBNAIL_SIZES, THUMBNAIL_FORMATS,
+                    THUMBNAIL_WORKERS, THUMBNAIL_PENDING_TIMEOUT, THUMBNAIL_FAILED_RETRY)
+from database import claim_thumbnails, forget_thumbnails, set_thumbnail_status, release_db
+import metrics
+from logs import configure_logging, get_logger
+
+logger = get_logger('thumbnails')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def thumbnail_key(file):
+    """Get the key thumbnails of a file are stored under
+
+    Blob-backed files share thumbnails with every copy of the same content.
+    """
+    return file['content_hash'] or f"file-{file['id']}"
+
+
+def thumbnail_path(key, size, image_format):
+    """Get where one rendition of a thumbnail lives on disk"""
+    extension = 'jpg' if image_format == 'jpeg' else image_format
+    return os.path.join(THUMBNAIL_FOLDER, key[:2], f'{key}-{size}.{extension}')
+
+
+def pick_size(requested):
+    """Get the smallest configured size that covers the requested one"""
+    for size in THUMBNAIL_SIZES:
+        if size >= requested:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+
+def request_thumbnails(file):
+    """Queue thumbnail generation for a file unless it's done or running
+
+    Never raises: the file is stored either way, and the next request for
+    its thumbnail queues it again.
+    """
+    key = thumbnail_key(file)
+    try:
+        if not claim_thumbnails(key, THUMBNAIL_PENDING_TIMEOUT, THUMBNAIL_FAILED_RETRY):
+            return
+    except Exception:
+        logger.exception('Could not claim thumbnails', extra={'source_key': key})
+        return
+
+    try:
+        future = _submit(render_thumbnails, file['filepath'], key, file['encoding'])
+    except Exception:
+        logger.exception('Could not queue thumbnails', extra={'source_key': key})
+        try:
+            forget_thumbnails(key, 'pending')
+        except Exception:
+            # Still retried once the claim times out
+            logger.exception('Could not release thumbnails', extra={'source_key': key})
+        return
+    future.add_done_callback(lambda f: _finish(key, f))
+
+
+def remove_thumbnails(key):
+    """Delete every rendition of a thumbnail from disk"""
+    for size in THUMBNAIL_SIZES:
+        for image_format in THUMBNAIL_FORMATS:
+            try:
+                os.remove(thumbnail_path(key, size, image_format))
+            except OSError:
+                pass
+
+
+def _get_executor():
+    """Start the worker pool on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned workers don't inherit the web server's threads and
+            # sockets, nor its logging setup
+            _executor = ProcessPoolExecutor(
+                max_workers=THUMBNAIL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=configure_logging
+            )
+            atexit.register(_executor.shutdown, wait=False, cancel_futures=True)
+    return _executor
+
+
+def _submit(*args):
+    """Submit a job to the worker pool, replacing the pool if it broke
+
+    A worker that dies, say out of memory or in a decoder crash, leaves
+    the pool refusing every later job.
+    """
+    global _executor
+    executor = _get_executor()
+    try:
+        return executor.submit(*args)
+    except BrokenProcessPool:
+        logger.warning('Thumbnail workers died, starting new ones')
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        return _get_executor().submit(*args)
+
+
+def _finish(key, future):
+    """Record the outcome of a render job in the thumbnail index"""
+    try:
+        error = future.exception()
+        status = 'ready' if error is None else 'failed'
+        if error is None:
+            metrics.thumbnail_duration.observe(future.result(), status)
+        else:
+            logger.warning('Thumbnail rendering failed', extra={'source_key': key, 'error': str(error)})
+        set_thumbnail_status(key, status)
+    finally:
+        release_db()
+
+
+def render_thumbnails(stored_key, key, encoding=None):
+    """Render every size and format of a thumbnail, runs in a worker process
+
+    Returns how long rendering took, in seconds.
+    """
+    started = time.perf_counter()
+    with blobstore.open_blob(stored_key, encoding) as source, Image.open(source) as img:
+        # JPEGs decode straight at a fraction of their resolution
+        largest = THUMBNAIL_SIZES[-1]
+        img.draft('RGB', (largest, largest))
+
+        img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+
+    os.makedirs(os.path.dirname(thumbnail_path(key, largest, 'webp')), exist_ok=True)
+
+    # Render from the largest size down, each from the previous one
+    for size in reversed(THUMBNAIL_SIZES):
+        img.thumbnail((size, size))
+
+        for image_format in THUMBNAIL_FORMATS:
+            rendition = img
+            if image_format == 'jpeg' and img.mode == 'RGBA':
+                # JPEG has no alpha, flatten onto white
+                rendition = Image.new('RGB', img.size, 'white')
+                rendition.paste(img, mask=img.getchannel('A'))
+
+            path = thumbnail_path(key, size, image_format)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            rendition.save(temp_path, format=image_format.upper(), quality=80)
+            os.replace(temp_path, path)
+
+    return time.perf_counter() - started
+
+
+def _has_alpha(img):
+    """Check whether an image has transparency to keep"""
+    return img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info